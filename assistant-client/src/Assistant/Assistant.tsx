@@ -1,5 +1,5 @@
 import React, { useEffect, useRef, useState } from "react";
-import { AssistantState, Message, SearchKey } from "./types";
+import { AssistantMessage, AssistantState, Message, SearchKey } from "./types";
 // import chatBubbleActive from './assets/chat-bubbles.svg';
 // import chatBubbleInactive from './assets/chat-bubbles-gray.svg';
 import MessagePanel from "./message/Message";
@@ -101,20 +101,22 @@ export default function Assistant(props: AssistantInputs) {
 
     const pollMessage = async () => {
         if (!myState.conversation || !myState.inContextUserName) return;
-        const pendingMsg = myState.conversation.messages.find((m) => m.sender === 'assistant' && m.state === 'pending');
+        const pendingMsg = myState.conversation.messages.find((m) => m.sender === 'assistant' && (m.state === 'pending' || m.state === 'streaming'));
         if (!pendingMsg) return;
         const msgId = pendingMsg.messageId;
         try {
             const res = await api.pollMessage(myState.conversation.conversationId, msgId, myState.inContextUserName);
-            if (res && res.state === 'pending') {
+            if (res && res.state !== 'pending') {
+                setMyState(s => ({
+                    ...s, conversation: {
+                        ...s.conversation!,
+                        messages: s.conversation!.messages.map((m) => m.messageId === msgId ? res : m)
+                    }
+                }));
+            }
+            if (res && (res.state === 'pending' || res.state === 'streaming')) {
                 return setTimeout(pollMessage, 1000);
             }
-            setMyState(s => ({
-                ...s, conversation: {
-                    ...s.conversation!,
-                    messages: s.conversation!.messages.map((m) => m.messageId === msgId ? res : m)
-                }
-            }));
         }
         catch (e) {
             console.error('Error polling message:', e);
@@ -124,6 +126,29 @@ export default function Assistant(props: AssistantInputs) {
         }
     }
 
+    const followMessage = (conversationId: string, msgId: string, userName: string) => {
+        const updateMessage = (update: (m: AssistantMessage) => AssistantMessage) => setMyState(s => ({
+            ...s, conversation: {
+                ...s.conversation!,
+                messages: s.conversation!.messages.map((m) => m.messageId === msgId ? update(m as AssistantMessage) : m)
+            }
+        }));
+        let done = false;
+        const close = api.subscribeMessage(conversationId, msgId, userName,
+            (msg) => {
+                updateMessage(() => msg);
+                if (msg.state !== 'pending' && msg.state !== 'streaming') {
+                    done = true;
+                    close();
+                }
+            },
+            (offset, content) => updateMessage((m) => ({ ...m, state: 'streaming', content: m.content.slice(0, offset) + content })),
+            () => {
+                if (!done) setTimeout(pollMessage, 1000);
+            },
+        );
+    };
+
     const toggleShow = (shown: boolean) => () => {
         setMyState({
             ...myState,
@@ -155,7 +180,7 @@ export default function Assistant(props: AssistantInputs) {
                 newState.conversation.messages = newMessages;
             }
             setMyState(newState);
-            setTimeout(pollMessage, 1000);
+            followMessage(myState.conversation.conversationId, assistantMessage.messageId, myState.inContextUserName);
         }
         catch (e) {
             console.error('Error sending message:', e);
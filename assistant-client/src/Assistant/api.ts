@@ -1,4 +1,4 @@
-import { AssistantMessage, Conversation, IdString, Message, MessagePair, SearchKey, UserMessage } from "./types";
+import { AssistantMessage, Conversation, IdString, MatchMode, Message, MessagePair, SearchKey, UserMessage } from "./types";
 
 const K_SELECTORS = [
     ["-kwr"],
@@ -41,6 +41,10 @@ export class AssistantApi {
             headers: { 'Content-Type': 'application/json', },
             body: JSON.stringify({ content: message }),
         });
+        if (!response.ok) {
+            // 503 when the server has too many answers in progress
+            throw new Error(`Failed to send message: ${response.status}`);
+        }
         const data: MessagePair = await response.json();
         return data;
     }
@@ -55,6 +59,34 @@ export class AssistantApi {
         return data;
     }
 
+    /** Follows a pending assistant message over server-sent events.
+     * `onError` is called when push is unavailable, so the caller can fall back to `pollMessage`.
+     * Returns a function that closes the stream.
+     */
+    subscribeMessage(
+        conversationId: string, msgId: string, userId: string,
+        onMessage: (message: AssistantMessage) => void,
+        onDelta: (offset: number, content: string) => void,
+        onError: () => void,
+    ): () => void {
+        if (typeof EventSource === 'undefined') {
+            onError();
+            return () => { };
+        }
+        const qp = new URLSearchParams({ userId }).toString();
+        const source = new EventSource(`${this.apiServer}/conversation/${conversationId}/message/${msgId}/events?${qp}`);
+        source.addEventListener('message', (e) => onMessage(JSON.parse((e as MessageEvent).data)));
+        source.addEventListener('delta', (e) => {
+            const { offset, content } = JSON.parse((e as MessageEvent).data);
+            onDelta(offset, content);
+        });
+        source.onerror = () => {
+            source.close();
+            onError();
+        };
+        return () => source.close();
+    }
+
     async sendFeedback(conversationId: string, msgId: string, liked: 1 | 0 | -1, userId: string): Promise<AssistantMessage> {
         const qp = new URLSearchParams({ userId }).toString();
         const response = await fetch(`${this.apiServer}/conversation/${conversationId}/message/${msgId}/feedback?${qp}`, {
@@ -76,12 +108,12 @@ export class AssistantApi {
         return data;
     }
 
-    async performCustomSearch(conversationId: string, searchKeys: SearchKey[], userId: string, countNeeded?: number): Promise<Conversation> {
+    async performCustomSearch(conversationId: string, searchKeys: SearchKey[], userId: string, countNeeded?: number, matchMode?: MatchMode): Promise<Conversation> {
         const qp = new URLSearchParams({ userId }).toString();
         const response = await fetch(`${this.apiServer}/conversation/${conversationId}/search?${qp}`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json', },
-            body: JSON.stringify({ searchKeys, countNeeded }),
+            body: JSON.stringify({ searchKeys, countNeeded, matchMode }),
         });
         const data: Conversation = await response.json();
         return data;
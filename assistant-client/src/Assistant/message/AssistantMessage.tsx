@@ -39,6 +39,8 @@ function LikeDislike({ message, onSendFeedback }: { message: AssistantMessage, o
 
 export default function AssistantMessagePanel({ message, onSendFeedback }: { message: AssistantMessage, onSendFeedback: CallableFunction }) {
     const completed = message.state === 'completed';
+    const streaming = message.state === 'streaming';
+    const failed = message.state === 'failed';
 
     return (
         <div className="pt-4 flex-col">
@@ -60,7 +62,15 @@ export default function AssistantMessagePanel({ message, onSendFeedback }: { mes
                             </div>
                         </div>
                     </div>
-                     {!completed && <div className="body p-2">...</div>}
+                     {!completed && !streaming && !failed && <div className="body p-2">...</div>}
+                    {failed && <div className="body p-2 italic text-red-700">{message.content}</div>}
+                    {streaming &&
+                        <div className="body p-2 overflow-x-auto">
+                            <ReactMarkdown remarkPlugins={[remarkGfm]}>
+                                {message.content}
+                            </ReactMarkdown>
+                        </div>
+                    }
                     {completed && <>
                         <div className="body p-2 overflow-x-auto">
                             <ReactMarkdown remarkPlugins={[remarkGfm]}>
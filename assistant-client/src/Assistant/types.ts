@@ -28,13 +28,15 @@ export interface AssistantMessage extends BaseMessage {
     followupPrompts: string[];
     actions: string[];
     liked: 1 | 0 | -1;
-    state?: 'pending' | 'completed';
+    state?: 'pending' | 'streaming' | 'completed' | 'failed';
 }
 
 export type Message = UserMessage | AssistantMessage | SearchResultsMessage | SearchRequestMessage;
 
 export type MessagePair = { userMessage: UserMessage, assistantMessage: AssistantMessage };
 
+export type MatchMode = 'ladder' | 'vector' | 'hybrid';
+
 export interface Conversation {
     conversationId: string;
     // type: 'conversation';
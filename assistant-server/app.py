@@ -1,26 +1,38 @@
 import os
 import logging
 import asyncio
+import time
+from datetime import datetime
 from quart import (
     Blueprint,
     Quart,
     jsonify,
     request,
-    # make_response, send_from_directory, render_template,
+    make_response,
+    # send_from_directory, render_template,
     current_app,
+    g,
 )
 from quart_cors import cors
 
-from openai import AsyncAzureOpenAI
-from openai.types.chat import ChatCompletion
+from openai import AsyncAzureOpenAI, AsyncStream, RateLimitError
+from openai.types.chat import ChatCompletionChunk
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
 # import copy
-# import json
+import json
 # import uuid
 # import httpx
 # from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
 from src.cosmos_client import CosmosConversationClient
 from src.ai_search import AISearchClient
-from src import init_openai_client, init_cosmosdb_conversation_client, init_search_client
+from src.pubsub import MessageBroker
+from src.prompt import PromptBuilder
+from src.jobs import JobScheduler
+from src.prewarm import Prewarmer
+from src import metrics
+from src import init_client_resources, init_message_broker, init_openai_client, init_cosmosdb_conversation_client, init_search_client, init_response_cache
+from src.response_cache import ResponseCache
+from src.cache import TTLCache
 
 bp = Blueprint("routes", __name__, static_folder="static", template_folder="static")
 api_bp = Blueprint("api", __name__, url_prefix="/api")
@@ -35,26 +47,165 @@ def create_app():
     app.register_blueprint(api_bp)
     app.config["TEMPLATES_AUTO_RELOAD"] = True
 
+    # requests being handled, so background work can wait for idle periods
+    app.in_flight = 0
+
+    @app.before_request
+    async def start_trace():
+        app.in_flight += 1
+        g.trace_id = request.headers.get("X-Request-ID") or metrics.new_trace_id()
+        g.trace_token = metrics.trace_id_var.set(g.trace_id)
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    async def end_trace(response):
+        if "request_start" in g:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            metrics.HTTP_SECONDS.observe(
+                time.perf_counter() - g.request_start,
+                method=request.method, route=route, status=response.status_code,
+            )
+            response.headers["X-Request-ID"] = g.trace_id
+        return response
+
+    @app.teardown_request
+    async def reset_trace(exc):
+        app.in_flight -= 1
+        if "trace_token" in g:
+            metrics.trace_id_var.reset(g.trace_token)
+
     @app.before_serving
     async def init():
+        # one credential and one connection pool per service, shared by all clients of this worker
+        app.client_resources = init_client_resources()
         try:
-            app.cosmos_conversation_client = await init_cosmosdb_conversation_client()
+            app.cosmos_conversation_client = await init_cosmosdb_conversation_client(app.client_resources)
             cosmos_db_ready.set()
         except Exception as e:
             logging.exception("Failed to initialize CosmosDB client")
             app.cosmos_conversation_client = None
             raise e
 
-        app.search_client = await init_search_client()
-        app.openai_client = await init_openai_client()
+        app.search_client = await init_search_client(app.client_resources)
+        if app.search_client and app.search_client.snapshot_source:
+            await app.search_client.load_snapshot()
+            app.search_client.start_snapshot_refresh()
+        if app.search_client and app.search_client.nearest_path:
+            await app.search_client.load_nearest()
+            app.search_client.start_nearest_refresh()
+        app.openai_client = await init_openai_client(app.client_resources)
+        app.response_cache = init_response_cache(app.openai_client)
+        app.message_broker = init_message_broker()
+        app.message_broker.start()
+        if METRICS_DIR:
+            metrics.init_store(METRICS_DIR, METRICS_FLUSH_INTERVAL).start()
+        app.prompt_builder = PromptBuilder(budget=PROMPT_TOKEN_BUDGET, cache_size=PROMPT_CACHE_SIZE)
+        app.chat_jobs = JobScheduler(
+            concurrency=CHAT_JOB_CONCURRENCY,
+            queue_size=CHAT_JOB_QUEUE_SIZE,
+            timeout=CHAT_JOB_TIMEOUT,
+            retries=CHAT_JOB_RETRIES,
+            retry_on=(RateLimitError,),
+        )
+        app.chat_jobs.start()
+
+        app.prewarmer = None
+        if PREWARM_ENABLED and app.search_client:
+            if app.search_client.cache is None:
+                logging.warning("Prewarming needs the search cache, SEARCH_CACHE_SIZE is 0")
+            elif isinstance(app.search_client.cache, TTLCache):
+                # every worker would warm its own copy of the same entries
+                logging.warning("Prewarming needs a shared search cache, set CACHE_BACKEND to sqlite or redis")
+            else:
+                app.prewarmer = Prewarmer(
+                    app.search_client,
+                    idle=lambda: app.in_flight <= PREWARM_IDLE_REQUESTS and app.chat_jobs.stats()["queued"] == 0,
+                    horizon_days=PREWARM_HORIZON_DAYS,
+                    interval=PREWARM_INTERVAL,
+                    batch=PREWARM_BATCH,
+                    concurrency=PREWARM_CONCURRENCY,
+                    cpu_budget=PREWARM_CPU_BUDGET,
+                    cache_share=PREWARM_CACHE_SHARE,
+                )
+                app.prewarmer.start()
+
+    @app.after_serving
+    async def shutdown():
+        if app.prewarmer:
+            await app.prewarmer.stop()
+        await app.chat_jobs.drain(CHAT_JOB_DRAIN_TIMEOUT)
+        await app.message_broker.close()
+        if app.search_client:
+            await app.search_client.close()
+        if app.response_cache:
+            await app.response_cache.close()
+        if app.cosmos_conversation_client:
+            await app.cosmos_conversation_client.close()
+        if app.openai_client:
+            await app.openai_client.close()
+        await app.client_resources.close()
+        if metrics.STORE:
+            await metrics.STORE.stop()
 
     return app
 
 
 # Debug settings
 DEBUG = os.environ.get("DEBUG", "false")
+# every log line carries the trace id of the request it was written for
+metrics.install_trace_ids()
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s"
 if DEBUG.lower() == "true" or DEBUG.lower() == "1":
-    logging.basicConfig(level=logging.DEBUG)
+    logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
+else:
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING").upper(), format=LOG_FORMAT)
+
+
+# Metrics of all worker processes are shared through files in METRICS_DIR, written every
+# METRICS_FLUSH_INTERVAL seconds; unset, /metrics reports the worker that answers the scrape
+METRICS_DIR = os.environ.get("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = int(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+
+
+# Streaming settings
+STREAM_FLUSH_TOKENS = int(os.environ.get("STREAM_FLUSH_TOKENS", "20"))
+STREAM_FLUSH_INTERVAL = int(os.environ.get("STREAM_FLUSH_INTERVAL_MS", "500")) / 1000
+
+
+# assistant message states that still receive updates
+ACTIVE_MESSAGE_STATES = ["pending", "streaming"]
+# how long a push subscriber waits for an event before re-reading the message; the longer
+# interval applies when events are shared across workers and a re-read is only a fallback
+SSE_RECHECK_INTERVAL = int(os.environ.get("SSE_RECHECK_INTERVAL_MS", "2000")) / 1000
+SSE_SHARED_RECHECK_INTERVAL = int(os.environ.get("SSE_SHARED_RECHECK_INTERVAL_MS", "15000")) / 1000
+
+
+# Prompt settings: token budget of the chat prompt, and how many rendered messages to keep
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "16000"))
+PROMPT_CACHE_SIZE = int(os.environ.get("PROMPT_CACHE_SIZE", "2048"))
+
+
+# Chat generation jobs: concurrent openai calls per worker, queued messages before answering 503,
+# seconds per attempt, retries on rate limits, and seconds to finish queued answers on shutdown
+CHAT_JOB_CONCURRENCY = int(os.environ.get("CHAT_JOB_CONCURRENCY", "4"))
+CHAT_JOB_QUEUE_SIZE = int(os.environ.get("CHAT_JOB_QUEUE_SIZE", "100"))
+CHAT_JOB_TIMEOUT = int(os.environ.get("CHAT_JOB_TIMEOUT", "120"))
+CHAT_JOB_RETRIES = int(os.environ.get("CHAT_JOB_RETRIES", "3"))
+CHAT_JOB_DRAIN_TIMEOUT = int(os.environ.get("CHAT_JOB_DRAIN_TIMEOUT", "30"))
+FAILED_MESSAGE_CONTENT = "Sorry, I could not answer this message. Please try again."
+
+
+# Prewarming of the search cache for chassis scheduled in the next PREWARM_HORIZON_DAYS days;
+# runs every PREWARM_INTERVAL seconds while at most PREWARM_IDLE_REQUESTS requests are in flight
+PREWARM_ENABLED = os.environ.get("PREWARM_ENABLED", "false").lower() in ("true", "1")
+PREWARM_HORIZON_DAYS = int(os.environ.get("PREWARM_HORIZON_DAYS", "7"))
+PREWARM_INTERVAL = int(os.environ.get("PREWARM_INTERVAL", "600"))
+PREWARM_BATCH = int(os.environ.get("PREWARM_BATCH", "500"))
+PREWARM_CONCURRENCY = int(os.environ.get("PREWARM_CONCURRENCY", "2"))
+PREWARM_CPU_BUDGET = float(os.environ.get("PREWARM_CPU_BUDGET", "0.25"))
+PREWARM_IDLE_REQUESTS = int(os.environ.get("PREWARM_IDLE_REQUESTS", "0"))
+# largest share of the search cache's maxsize one run may fill
+PREWARM_CACHE_SHARE = float(os.environ.get("PREWARM_CACHE_SHARE", "0.25"))
 
 
 # Frontend Settings via Environment Variables
@@ -70,6 +221,11 @@ def get_frontend_settings():
         return jsonify({"error": str(e)}), 500
 
 
+@bp.route("/metrics", methods=["GET"])
+async def get_metrics():
+    return await metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
 @bp.route("/version", methods=["GET"])
 async def version():
     from _version import VERSION
@@ -91,10 +247,10 @@ async def init_or_load_conversation():
         conv = await client.create_conversation(user_id=user_id, chassis_id=chassis_id)
         search_client: AISearchClient = current_app.search_client
         # 0. Get original chassis data for conversation
-        chassis_data = search_client.get_chassis_by_id(chassis_id)
+        chassis_data = await search_client.get_chassis_by_id(chassis_id)
         
         # 1. perform search
-        search_result = search_client.get_matching_chassis(chassis_id, count_needed=10)
+        search_result = await search_client.get_matching_chassis(chassis_id, count_needed=10)
 
         # 2. save search in cosmos message
         msg = await client.add_search_results_message(conv["id"], chassis_data, search_result)
@@ -105,41 +261,82 @@ async def init_or_load_conversation():
     return jsonify(conv)
 
 
-async def handle_chat(conv, oai_client: AsyncAzureOpenAI, cosmos_client:CosmosConversationClient, user_msg, assistant_msg):
+async def handle_chat(conv, oai_client: AsyncAzureOpenAI, cosmos_client:CosmosConversationClient, user_msg, assistant_msg, prompt_builder: PromptBuilder, broker: MessageBroker = None, response_cache: ResponseCache = None):
 
-    preamble = [
-        {
-            "role": "system",
-            "content": "You are Chassis design engineer assistant. A chassis engineer (working on the design of the chassis for a truck ordered by customer) is chatting with you. He is given a bunch of chassis that are similar to the chassis he is designing. Help answer his questions. When possible, display the results in tabular format. He may refer to the the base chassis as 'my chassis' or 'current chassis' and to the matching chassis as search results.",
-        },
-        {"role": "user", "content": "Show me the related chassis to my base chassis."},
-    ]
-    messages = []
-    for m in conv["messages"]:
-        if m["sender"] == "user":
-            messages.append({"role": "user", "content": m["content"]})
-        elif m["sender"] == "assistant" and m["state"] == "completed":
-            messages.append({"role": "assistant", "content": m["content"]})
-        elif m["sender"] == "search_request":
-            print("found a new search request, deleting previous chat_history")
-            messages = []
-        elif m["sender"] == "search_results":
-            content = f"My chassis (base):\nID: {m['baseChassis']['ID']}\n{m['baseChassis']['description']}\n\nRelated Chassis:\n"
-            for id, r in enumerate(m["results"]):
-                content += f"Item {id+1} ID: {r['ID']}\n{r['description']}\n\n"
-            messages.append({"role": "assistant", "content": content})
-    
-    messages.append({"role": "user", "content": user_msg["content"]})
-    messages = preamble + messages
+    messages, prompt_tokens = await prompt_builder.build(conv, user_msg["content"])
 
-    response: ChatCompletion = await oai_client.chat.completions.create(
+    vector = None
+    if response_cache:
+        cached, vector = await response_cache.get(messages)
+        if cached is not None:
+            logging.debug(f"Answering message {assistant_msg['id']} from the response cache")
+            if broker:
+                broker.publish(assistant_msg["id"], {"type": "delta", "offset": 0, "content": cached})
+            final = await cosmos_client.update_assistant_message(conv['conversationId'], assistant_msg["id"], cached)
+            if broker and final:
+                broker.publish(assistant_msg["id"], {"type": "message", "message": final})
+            return True
+
+    started = time.perf_counter()
+    stream: AsyncStream[ChatCompletionChunk] = await oai_client.chat.completions.create(
         messages=messages,
         temperature=0.7,
         max_tokens=1600,
-        stream=False,
+        stream=True,
         model=os.getenv("AZURE_OPENAI_MODEL"),
     )
-    final = await cosmos_client.update_assistant_message(conv['conversationId'],assistant_msg["id"], response.choices[0].message.content)
+
+    # every delta is published to local subscribers; partial content is written as a "streaming"
+    # message every STREAM_FLUSH_TOKENS tokens or STREAM_FLUSH_INTERVAL_MS, whichever comes first
+    parts = []
+    length = 0
+    unflushed = 0
+    # this task is the only writer of the message, so a concurrent change is an error
+    etag = assistant_msg.get("_etag")
+    last_flush = time.monotonic()
+    usage = None
+    async for chunk in stream:
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        if not parts:
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage="openai.first_token")
+        if broker:
+            broker.publish(assistant_msg["id"], {"type": "delta", "offset": length, "content": delta})
+        parts.append(delta)
+        length += len(delta)
+        unflushed += 1
+        if unflushed >= STREAM_FLUSH_TOKENS or time.monotonic() - last_flush >= STREAM_FLUSH_INTERVAL:
+            msg = await cosmos_client.update_assistant_message(conv['conversationId'], assistant_msg["id"], "".join(parts), state="streaming", etag=etag)
+            if msg:
+                etag = msg.get("_etag")
+                # a retried attempt continues from the latest version
+                assistant_msg["_etag"] = etag
+                if broker:
+                    broker.publish(assistant_msg["id"], {"type": "message", "message": msg})
+            unflushed = 0
+            last_flush = time.monotonic()
+
+    content = "".join(parts)
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage="openai.chat")
+    if usage:
+        metrics.record_tokens("chat", usage.prompt_tokens, usage.completion_tokens)
+    else:
+        # streamed completions do not report usage on this api version
+        metrics.record_tokens(
+            "chat",
+            prompt_tokens,
+            prompt_builder.count_tokens(content),
+        )
+    final = await cosmos_client.update_assistant_message(conv['conversationId'],assistant_msg["id"], content, etag=etag)
+    if response_cache and content:
+        await response_cache.set(messages, content, vector)
+    if broker and final:
+        broker.publish(assistant_msg["id"], {"type": "message", "message": final})
     return True
 
 
@@ -157,11 +354,33 @@ async def post_message(conversation_id):
     if conv is None:
         return jsonify({"error": "conversation not found or user does not own it"}), 404
 
-    message = await request.get_json()
-    user_msg = await client.add_user_message(conversation_id, message["content"])
-    assistant_msg = await client.add_assistant_message(conversation_id, user_msg["id"])
+    jobs: JobScheduler = current_app.chat_jobs
+    if jobs.full():
+        return jsonify({"error": "too many messages in progress, try again later"}), 503
 
-    asyncio.create_task(handle_chat(conv, current_app.openai_client, client, user_msg, assistant_msg))
+    message = await request.get_json()
+    user_msg, assistant_msg = await client.add_message_pair(conversation_id, message["content"])
+
+    # jobs run outside the request context, so resolve the app attributes now
+    oai_client = current_app.openai_client
+    prompt_builder = current_app.prompt_builder
+    broker = current_app.message_broker
+    response_cache = current_app.response_cache
+
+    async def fail(error):
+        msg = await client.update_assistant_message(conversation_id, assistant_msg["id"], FAILED_MESSAGE_CONTENT, state="failed")
+        if msg:
+            broker.publish(assistant_msg["id"], {"type": "message", "message": msg})
+
+    submitted = jobs.submit(
+        assistant_msg["id"],
+        lambda: handle_chat(conv, oai_client, client, user_msg, assistant_msg, prompt_builder, broker, response_cache),
+        on_failure=fail,
+    )
+    if not submitted:
+        # the queue filled up while the messages were written
+        await fail(None)
+        return jsonify({"error": "too many messages in progress, try again later"}), 503
 
     return jsonify(
         {"status": "ok", "userMessage": user_msg, "assistantMessage": assistant_msg}
@@ -189,15 +408,21 @@ async def post_new_search(conversation_id):
     chassis_id = conv.get("chassisId")
     search_keys = body.get("searchKeys", [])
     count_needed = body.get("countNeeded", None)
-    await cosmos_client.add_search_request_message(conversation_id, search_keys)
+    # optional per request; defaults to AZURE_SEARCH_MATCH_MODE
+    match_mode = body.get("matchMode", None)
+    if match_mode is not None and match_mode not in AISearchClient.match_modes:
+        return jsonify({"error": f"matchMode must be one of {AISearchClient.match_modes}"}), 400
+    requested_at = int(datetime.now().timestamp())
     
-    base_chassis = search_client.get_chassis_by_id(chassis_id)
+    base_chassis = await search_client.get_chassis_by_id(chassis_id)
     
     selected_search_keys = [k for k in search_keys if k['selected']==True]
-    results = search_client.get_matching_chassis_custom(chassis_id, selected_search_keys, count_needed)
-    await cosmos_client.add_search_results_message(conversation_id, base_chassis, results)
+    results = await search_client.get_matching_chassis_custom(chassis_id, selected_search_keys, count_needed, mode=match_mode)
+    request_msg, results_msg = await cosmos_client.add_search_messages(
+        conversation_id, search_keys, base_chassis, results, requested_at=requested_at
+    )
     
-    conv = await cosmos_client.verify_conversation(conversation_id, user_id, with_messages=True)
+    conv["messages"] += [request_msg, results_msg]
     return jsonify( conv )
     
 
@@ -221,6 +446,76 @@ async def poll_message(conversation_id, message_id):
         return jsonify({"error": "message not found"}), 404
 
 
+def sse_event(event, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# pushes updates of a pending assistant message; the polling route above remains as a fallback
+@api_bp.route("/conversation/<conversation_id>/message/<message_id>/events", methods=["GET"])
+async def message_events(conversation_id, message_id):
+    user_id = request.args.get("userId")
+    if not user_id:
+        return jsonify({"error": "user_id is required"}), 400
+
+    client: CosmosConversationClient = current_app.cosmos_conversation_client
+    conv = await client.verify_conversation(
+        conversation_id, user_id, with_messages=False
+    )
+    if conv is None:
+        return jsonify({"error": "conversation not found or user does not own it"}), 404
+
+    broker: MessageBroker = current_app.message_broker
+    recheck_interval = SSE_SHARED_RECHECK_INTERVAL if broker.shared else SSE_RECHECK_INTERVAL
+
+    async def retrieve():
+        # the headers are already sent, so a missing message is reported as an event
+        try:
+            return await client.retrieve_message(conversation_id, message_id)
+        except CosmosResourceNotFoundError:
+            return None
+
+    async def events():
+        # subscribe before reading so no delta falls between the read and the subscription;
+        # deltas carry their offset, so ones already contained in the read are harmless
+        with broker.subscribe(message_id) as queue:
+            message = await retrieve()
+            if not message:
+                yield sse_event("error", {"error": "message not found"})
+                return
+            yield sse_event("message", message)
+
+            while message.get("state") in ACTIVE_MESSAGE_STATES:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=recheck_interval)
+                except asyncio.TimeoutError:
+                    # nothing received, e.g. the answer is generated by another worker and events
+                    # are not shared, or redis is unreachable
+                    message = await retrieve()
+                    if not message:
+                        # deleted while streaming
+                        yield sse_event("error", {"error": "message not found"})
+                        return
+                    yield sse_event("message", message)
+                    continue
+
+                if event["type"] == "delta":
+                    yield sse_event("delta", {"offset": event["offset"], "content": event["content"]})
+                else:
+                    message = event["message"]
+                    yield sse_event("message", message)
+
+    response = await make_response(
+        events(),
+        {
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        },
+    )
+    response.timeout = None
+    return response
+
+
 @api_bp.route("/conversation/<conversation_id>/message/<message_id>/feedback", methods=["PUT"])
 async def update_feedback(conversation_id, message_id):
     user_id = request.args.get("userId")
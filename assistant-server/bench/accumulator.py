@@ -0,0 +1,69 @@
+"""Micro-benchmark: list-based dedup + full sort vs MatchAccumulator.
+
+Run from assistant-server: python -m bench.accumulator --candidates 10000
+"""
+import argparse
+import random
+import time
+
+from src.matching import MatchAccumulator
+
+
+def make_results(candidates, duplicates, seed=0):
+    rnd = random.Random(seed)
+    ids = [f"C{i:06d}_P2024" for i in range(candidates)]
+    results = [{"ID": i, "_score": rnd.randint(0, 34) / 34} for i in ids]
+    results += [dict(rnd.choice(results)) for _ in range(duplicates)]
+    rnd.shuffle(results)
+    return results
+
+
+def list_based(results, count_needed):
+    all_matched_chassis = []
+    for result in results:
+        if result['ID'] not in [m['ID'] for m in all_matched_chassis]:
+            all_matched_chassis.append(result)
+
+    filtered_list = []
+    for c in all_matched_chassis:
+        filtered_list_ids = [f["ID"] for f in filtered_list]
+        if c['ID'] not in filtered_list_ids:
+            filtered_list.append(c)
+
+    filtered_list = sorted(filtered_list, key=lambda x: x["_score"], reverse=True)
+    return filtered_list[:count_needed]
+
+
+def accumulator_based(results, count_needed):
+    all_matched_chassis = MatchAccumulator()
+    for result in results:
+        all_matched_chassis.add(result)
+    return all_matched_chassis.top(count_needed)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--candidates", type=int, default=10000)
+    parser.add_argument("--duplicates", type=int, default=1000)
+    parser.add_argument("--count-needed", type=int, default=10)
+    args = parser.parse_args()
+
+    results = make_results(args.candidates, args.duplicates)
+    old, old_time = timed(list_based, results, args.count_needed)
+    new, new_time = timed(accumulator_based, results, args.count_needed)
+
+    assert [r["ID"] for r in old] == [r["ID"] for r in new], "rankings differ"
+    print(f"candidates={args.candidates} duplicates={args.duplicates} count_needed={args.count_needed}")
+    print(f"list dedup + sort:  {old_time * 1000:10.2f} ms")
+    print(f"MatchAccumulator:   {new_time * 1000:10.2f} ms")
+    print(f"speedup:            {old_time / new_time:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""In-process stand-ins for Azure AI Search, Cosmos DB and Azure OpenAI used by the benchmarks.
+
+They implement only the calls the server makes, with a fixed latency per call, and keep their
+data in memory. Every fake counts its calls in `ops` so a benchmark can report them.
+"""
+import asyncio
+import copy
+import hashlib
+import random
+import re
+import uuid
+from collections import Counter
+from types import SimpleNamespace
+
+from azure.cosmos import exceptions
+
+from src.ai_search import AISearchClient
+
+
+def catalog_keys() -> list[str]:
+    return [key["name"] for key in AISearchClient.search_keys(None, extended=True)]
+
+
+def make_catalog(size=2000, *, values=4, seed=0) -> list[dict]:
+    """Synthetic chassis documents with every search key set.
+
+    Key i takes one of 2 + i % values values, so some keys are nearly constant and others spread
+    the catalog out, which makes the relaxation ladder run a realistic number of levels.
+    """
+    rnd = random.Random(seed)
+    keys = catalog_keys()
+    documents = []
+    for i in range(size):
+        doc = {
+            "ID": f"C{i:06d}_P2024",
+            "description": f"Synthetic chassis {i}",
+            "division": "bench",
+            "chassis_number": str(i),
+            "defects": [],
+            "links": [],
+        }
+        for j, name in enumerate(keys):
+            doc[name] = f"{name}-{rnd.randrange(2 + j % values)}"
+        documents.append(doc)
+    return documents
+
+
+class FakeSearchResults:
+    def __init__(self, documents, count):
+        self._documents = documents
+        self._count = count
+
+    async def get_count(self):
+        return self._count
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._documents:
+            yield doc
+
+
+class FakeSearchClient:
+    """Evaluates the `name: 'value' + ...` queries of the relaxation ladder and a small OData
+    subset: comparisons (as strings), `search.in` and `and`.
+
+    As on the service, clauses joined by `+` are all required whatever the search mode, and with
+    `|` or spaces `search_mode` decides. A vector query adds its k nearest neighbours (a stable
+    pseudo-random order per query text) among the filtered documents to the keyword matches.
+    """
+
+    CLAUSE = re.compile(r"(\w+):\s*'((?:[^'\\]|\\.)*)'")
+    COMPARISON = re.compile(r"(\w+) (eq|ne|gt|ge|lt|le) (?:'((?:[^']|'')*)'|([\w.:-]+))$")
+    SEARCH_IN = re.compile(r"search\.in\((\w+),\s*'([^']*)'(?:,\s*'(.)')?\)$")
+    REQUIRED = re.compile(r"(?<!\\) \+ ")
+
+    def __init__(self, documents, latency=0.0):
+        self.documents = documents
+        self.latency = latency
+        self.ops = Counter()
+
+    async def close(self):
+        pass
+
+    def _matches_filter(self, doc, expression) -> bool:
+        for part in re.split(r"\s+and\s+", expression):
+            part = part.strip()
+            m = self.SEARCH_IN.match(part)
+            if m:
+                if str(doc.get(m.group(1))) not in m.group(2).split(m.group(3) or ","):
+                    return False
+                continue
+            part = part.strip("()")
+            m = self.COMPARISON.match(part)
+            if m:
+                name, op = m.group(1), m.group(2)
+                value = m.group(3).replace("''", "'") if m.group(3) is not None else m.group(4)
+                actual = str(doc.get(name))
+                ok = {"eq": actual == value, "ne": actual != value, "gt": actual > value,
+                      "ge": actual >= value, "lt": actual < value, "le": actual <= value}[op]
+                if not ok:
+                    return False
+                continue
+            raise ValueError(f"unsupported filter: {part}")
+        return True
+
+    async def search(self, search_text=None, *, search_fields=None, filter=None, select=None, skip=0, top=None,
+                     order_by=None, vector_queries=None, search_mode="any", include_total_count=False, **kwargs):
+        self.ops["search" if top != 0 else "count"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        clauses = []
+        vector_text = str(getattr(vector_queries[0], "text", "")) if vector_queries else ""
+        documents = self.documents
+        if filter:
+            documents = [doc for doc in documents if self._matches_filter(doc, filter)]
+        if search_fields == ["ID"]:
+            matches = [doc for doc in documents if doc["ID"] == search_text]
+        else:
+            clauses = [(name, re.sub(r"\\(.)", r"\1", value)) for name, value in self.CLAUSE.findall(search_text or "")]
+            required = all if search_mode == "all" or self.REQUIRED.search(search_text or "") else any
+            if search_text is None:
+                matches = [] if vector_queries else list(documents)
+            else:
+                matches = [doc for doc in documents if not clauses or required(str(doc.get(n)) == v for n, v in clauses)]
+        if vector_queries:
+            nearest = sorted(documents, key=lambda doc: hashlib.md5((vector_text + doc["ID"]).encode()).digest())
+            seen = {doc["ID"] for doc in matches}
+            matches += [doc for doc in nearest[:vector_queries[0].k_nearest_neighbors] if doc["ID"] not in seen]
+
+        if order_by:
+            field = order_by[0].split()[0]
+            matches = sorted(matches, key=lambda doc: str(doc.get(field)), reverse=order_by[0].endswith(" desc"))
+        else:
+            # stand-in for relevance: matching clauses first, then a stable order that differs per query
+            salt = str(search_text) + vector_text
+            matches = sorted(matches, key=lambda doc: (
+                -sum(str(doc.get(n)) == v for n, v in clauses),
+                hashlib.md5((salt + doc["ID"]).encode()).digest(),
+            ))
+
+        count = len(matches)
+        page = matches[skip:] if top is None else matches[skip:skip + top]
+        if select:
+            page = [{name: doc.get(name) for name in select} for doc in page]
+        else:
+            page = [dict(doc) for doc in page]
+        return FakeSearchResults(page, count)
+
+
+class FakeContainer:
+    """Cosmos container keyed by (partition key, id), with the query shapes the client uses."""
+
+    QUERY = re.compile(r"SELECT (.*?) FROM c(?: WHERE (.*?))?(?: ORDER BY c\.(\w+)( DESC)?)?$", re.S | re.I)
+    CONDITION = re.compile(r"c\.(\w+)\s*(=|>=|>|<=|<|!=)\s*(.+)$")
+
+    def __init__(self, latency=0.0):
+        self.items = {}
+        self.latency = latency
+        self.ops = Counter()
+
+    async def _call(self, op):
+        self.ops[op] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    @staticmethod
+    def _not_found():
+        return exceptions.CosmosResourceNotFoundError(status_code=404, message="Entity with the specified id does not exist")
+
+    @staticmethod
+    def _stamp(doc) -> dict:
+        doc = copy.deepcopy(doc)
+        doc["_etag"] = uuid.uuid4().hex
+        return doc
+
+    async def read(self):
+        return {}
+
+    async def read_item(self, item, partition_key, **kwargs):
+        await self._call("read")
+        doc = self.items.get((partition_key, item))
+        if doc is None:
+            raise self._not_found()
+        return copy.deepcopy(doc)
+
+    async def upsert_item(self, body, **kwargs):
+        await self._call("upsert")
+        doc = self._stamp(body)
+        self.items[(doc["conversationId"], doc["id"])] = doc
+        return copy.deepcopy(doc)
+
+    async def create_item(self, body, **kwargs):
+        await self._call("create")
+        if (body["conversationId"], body["id"]) in self.items:
+            raise exceptions.CosmosResourceExistsError(status_code=409, message="Entity with the specified id already exists")
+        doc = self._stamp(body)
+        self.items[(doc["conversationId"], doc["id"])] = doc
+        return copy.deepcopy(doc)
+
+    async def delete_item(self, item, partition_key, **kwargs):
+        await self._call("delete")
+        item_id = item["id"] if isinstance(item, dict) else item
+        if self.items.pop((partition_key, item_id), None) is None:
+            raise self._not_found()
+
+    async def patch_item(self, item, partition_key, patch_operations, **kwargs):
+        await self._call("patch")
+        doc = self.items.get((partition_key, item))
+        if doc is None:
+            raise self._not_found()
+        if kwargs.get("etag") and kwargs.get("match_condition") is not None and kwargs["etag"] != doc["_etag"]:
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="Precondition failed")
+        doc = copy.deepcopy(doc)
+        for op in patch_operations:
+            path = op["path"].strip("/")
+            if op["op"] in ("set", "replace", "add"):
+                doc[path] = op["value"]
+            elif op["op"] == "incr":
+                doc[path] = doc.get(path, 0) + op["value"]
+            elif op["op"] == "remove":
+                doc.pop(path, None)
+        doc = self._stamp(doc)
+        self.items[(partition_key, item)] = doc
+        return copy.deepcopy(doc)
+
+    async def execute_item_batch(self, batch_operations, partition_key, **kwargs):
+        await self._call("batch")
+        results = []
+        for op, args, *_ in batch_operations:
+            if op in ("upsert", "create"):
+                doc = self._stamp(args[0])
+                self.items[(partition_key, doc["id"])] = doc
+                results.append({"statusCode": 200, "resourceBody": copy.deepcopy(doc)})
+            elif op == "delete":
+                self.items.pop((partition_key, args[0]), None)
+                results.append({"statusCode": 204})
+            else:
+                raise ValueError(f"unsupported batch operation: {op}")
+        return results
+
+    def _value(self, token, parameters):
+        token = token.strip()
+        if token.startswith("@"):
+            return parameters[token]
+        if token.startswith("'"):
+            return token[1:-1].replace("''", "'")
+        return float(token) if "." in token else int(token)
+
+    def _matches(self, doc, conditions, parameters) -> bool:
+        for condition in conditions:
+            m = self.CONDITION.match(condition.strip().strip("()"))
+            if not m:
+                raise ValueError(f"unsupported condition: {condition}")
+            name, op, value = m.group(1), m.group(2), self._value(m.group(3), parameters)
+            actual = doc.get(name)
+            if actual is None:
+                return False
+            ok = {"=": actual == value, "!=": actual != value, ">=": actual >= value,
+                  ">": actual > value, "<=": actual <= value, "<": actual < value}[op]
+            if not ok:
+                return False
+        return True
+
+    def query_items(self, query, parameters=None, partition_key=None, **kwargs):
+        self.ops["query" if partition_key is not None else "cross_partition_query"] += 1
+        parameters = {p["name"]: p["value"] for p in parameters or []}
+        m = self.QUERY.match(query.strip())
+        if not m:
+            raise ValueError(f"unsupported query: {query}")
+        projection, where, order, descending = m.groups()
+        conditions = re.split(r"\s+and\s+", where, flags=re.I) if where else []
+
+        docs = [
+            doc for (pk, _), doc in self.items.items()
+            if (partition_key is None or pk == partition_key) and self._matches(doc, conditions, parameters)
+        ]
+        if order:
+            docs.sort(key=lambda doc: doc.get(order), reverse=bool(descending))
+        if projection.strip() != "*":
+            fields = [field.strip()[2:] for field in projection.split(",")]
+            docs = [{f: doc[f] for f in fields if f in doc} for doc in docs]
+        docs = copy.deepcopy(docs)
+
+        async def iterate():
+            await self._call("query_page")
+            for doc in docs:
+                yield doc
+        return iterate()
+
+
+class FakeStream:
+    def __init__(self, tokens, latency):
+        self.tokens = tokens
+        self.latency = latency
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for token in self.tokens:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            delta = SimpleNamespace(content=token)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=None)], usage=None)
+
+
+class FakeOpenAI:
+    """Chat completions stream `tokens` tokens after `latency` seconds, one every `token_latency`
+    seconds; embeddings are bag-of-words hashes so similar questions get similar vectors."""
+
+    def __init__(self, *, latency=0.0, token_latency=0.0, tokens=50, dimensions=64):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.tokens = tokens
+        self.dimensions = dimensions
+        self.ops = Counter()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.embeddings = SimpleNamespace(create=self._embed)
+
+    async def close(self):
+        pass
+
+    async def _chat(self, messages, stream=False, **kwargs):
+        self.ops["chat"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        tokens = [f"token{i} " for i in range(self.tokens)]
+        if stream:
+            return FakeStream(tokens, self.token_latency)
+        usage = SimpleNamespace(prompt_tokens=0, completion_tokens=len(tokens), total_tokens=len(tokens))
+        message = SimpleNamespace(content="".join(tokens))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+    async def _embed(self, input, model=None, **kwargs):
+        self.ops["embedding"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        data = []
+        for text in input:
+            vector = [0.0] * self.dimensions
+            for word in text.lower().split():
+                vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.dimensions] += 1.0
+            data.append(SimpleNamespace(embedding=vector))
+        return SimpleNamespace(data=data, usage=SimpleNamespace(prompt_tokens=sum(len(t.split()) for t in input)))
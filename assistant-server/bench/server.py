@@ -0,0 +1,168 @@
+"""End-to-end benchmark of the API against in-process fakes of Search, Cosmos and OpenAI.
+
+Every session opens a conversation for a new (user, chassis) pair, which runs the default match,
+sends a chat message and polls it until it is answered, then runs a custom search. Sessions run
+`--concurrency` at a time; latency percentiles are reported per route.
+
+Run from assistant-server: python -m bench.server --sessions 200 --concurrency 20
+"""
+import argparse
+import asyncio
+import logging
+import math
+import os
+import random
+import time
+from collections import defaultdict
+
+os.environ.setdefault("AZURE_OPENAI_MODEL", "bench")
+
+import app as server
+from src.ai_search import AISearchClient
+from src.cosmos_client import CosmosConversationClient
+from src.cache import TTLCache
+from bench.fakes import FakeContainer, FakeOpenAI, FakeSearchClient, make_catalog
+
+
+def percentile(values, p):
+    # nearest-rank percentile
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def install_fakes(args, documents):
+    """Point the app's init functions at the fakes; returns the fakes for reporting."""
+    search = FakeSearchClient(documents, latency=args.search_latency / 1000)
+    container = FakeContainer(latency=args.cosmos_latency / 1000)
+    openai = FakeOpenAI(
+        latency=args.openai_latency / 1000,
+        token_latency=args.token_latency / 1000,
+        tokens=args.tokens,
+    )
+
+    async def init_search_client(resources=None):
+        client = AISearchClient(
+            "https://bench.search.windows.net/", "bench", "bench",
+            match_concurrency=args.match_concurrency,
+            match_strategy=args.match_strategy,
+            match_mode=args.match_mode,
+            cache=TTLCache(name="search") if args.cache else None,
+        )
+        await client.search_client.close()
+        client.search_client = search
+        return client
+
+    async def init_cosmosdb_conversation_client(resources=None):
+        client = CosmosConversationClient(
+            cosmosdb_endpoint="https://bench.documents.azure.com:443/",
+            credential="YmVuY2g=",
+            database_name="bench",
+            container_name="bench",
+            cache=TTLCache(ttl=60, name="conversation") if args.cache else None,
+        )
+        await client.cosmosdb_client.close()
+        client.container_client = container
+        return client
+
+    async def init_openai_client(resources=None):
+        return openai
+
+    server.init_search_client = init_search_client
+    server.init_cosmosdb_conversation_client = init_cosmosdb_conversation_client
+    server.init_openai_client = init_openai_client
+    return search, container, openai
+
+
+async def run_session(client, i, chassis_id, timings, args):
+    user_id = f"bench-user-{i}"
+
+    async def call(route, method, path, **kwargs):
+        start = time.perf_counter()
+        response = await client.open(path, method=method, **kwargs)
+        timings[route].append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f"{method} {path} returned {response.status_code}")
+        return await response.get_json()
+
+    conv = await call("GET /conversation", "GET", f"/api/conversation?chassisId={chassis_id}&userId={user_id}")
+    conversation_id = conv["conversationId"]
+
+    pair = await call(
+        "POST /message", "POST", f"/api/conversation/{conversation_id}/message?userId={user_id}",
+        json={"content": "Compare the wheelbase of the results as a table"},
+    )
+    message_id = pair["assistantMessage"]["id"]
+    start = time.perf_counter()
+    while True:
+        message = await call("GET /message (poll)", "GET", f"/api/conversation/{conversation_id}/message/{message_id}?userId={user_id}")
+        if message.get("state") not in server.ACTIVE_MESSAGE_STATES:
+            break
+        await asyncio.sleep(args.poll_interval / 1000)
+    timings["answer (post to completed)"].append(time.perf_counter() - start)
+
+    keys = AISearchClient.search_keys(None)
+    selected = [dict(k, selected=True, mandatory=j < 3) for j, k in enumerate(keys[:12])]
+    await call(
+        "POST /search", "POST", f"/api/conversation/{conversation_id}/search?userId={user_id}",
+        json={"searchKeys": selected, "countNeeded": 10},
+    )
+
+
+async def main(args):
+    documents = make_catalog(args.catalog, seed=args.seed)
+    search, container, openai = install_fakes(args, documents)
+    app = server.create_app()
+    chassis_ids = random.Random(args.seed).choices([doc["ID"] for doc in documents], k=args.sessions)
+    timings = defaultdict(list)
+    errors = []
+
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def session(i):
+            async with semaphore:
+                try:
+                    await run_session(client, i, chassis_ids[i], timings, args)
+                except Exception as e:
+                    errors.append(e)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(session(i) for i in range(args.sessions)))
+        elapsed = time.perf_counter() - start
+
+    requests = sum(len(v) for route, v in timings.items() if route.startswith(("GET", "POST")))
+    print(f"catalog={args.catalog} sessions={args.sessions} concurrency={args.concurrency} "
+          f"mode={args.match_mode} strategy={args.match_strategy} match_concurrency={args.match_concurrency}")
+    print(f"elapsed {elapsed:.2f}s  {args.sessions / elapsed:.1f} sessions/s  {requests / elapsed:.1f} requests/s  errors {len(errors)}")
+    print(f"{'route':<28}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, values in timings.items():
+        print(f"{route:<28}{len(values):>7}" + "".join(f"{percentile(values, p) * 1000:>10.1f}" for p in (50, 95, 99)))
+    print("search calls:", dict(search.ops))
+    print("cosmos calls:", dict(container.ops))
+    print("openai calls:", dict(openai.ops))
+    if errors:
+        print("first error:", repr(errors[0]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--catalog", type=int, default=2000, help="number of synthetic chassis")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--search-latency", type=float, default=20, help="ms per search call")
+    parser.add_argument("--cosmos-latency", type=float, default=5, help="ms per cosmos call")
+    parser.add_argument("--openai-latency", type=float, default=300, help="ms to the first token")
+    parser.add_argument("--token-latency", type=float, default=10, help="ms per streamed token")
+    parser.add_argument("--tokens", type=int, default=50, help="tokens per answer")
+    parser.add_argument("--poll-interval", type=float, default=200, help="ms between polls")
+    parser.add_argument("--match-strategy", default="ladder", choices=["ladder", "probe"])
+    parser.add_argument("--match-concurrency", type=int, default=1)
+    parser.add_argument("--match-mode", default="ladder", choices=AISearchClient.match_modes)
+    parser.add_argument("--cache", action="store_true", help="enable the search and conversation caches")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    # the app configures logging on import
+    logging.getLogger().setLevel(args.log_level)
+    asyncio.run(main(args))
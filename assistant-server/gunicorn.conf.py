@@ -1,4 +1,7 @@
 import multiprocessing
+import os
+import shutil
+import tempfile
 
 max_requests = 1000
 max_requests_jitter = 50
@@ -10,4 +13,12 @@ timeout = 230
 
 num_cpus = multiprocessing.cpu_count()
 workers = (num_cpus * 2) + 1
-worker_class = "uvicorn.workers.UvicornWorker"
\ No newline at end of file
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# metrics of all workers are shared through files in this directory, see src/metrics.py
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), "assistant-metrics"))
+
+
+def on_starting(server):
+    # every server start begins with empty metrics
+    shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)
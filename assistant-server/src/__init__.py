@@ -1,12 +1,142 @@
 import os 
+import asyncio
+import time
 from src.ai_search import AISearchClient
 from src.cosmos_client import CosmosConversationClient
-from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
+from src.cache import CacheBackend, TTLCache, SQLiteCache, RedisCache
+from src.response_cache import ResponseCache
+from src.pubsub import MessageBroker, RedisMessageBroker
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.identity.aio import DefaultAzureCredential
 from openai import AsyncAzureOpenAI
+import aiohttp
+import httpx
 import logging 
+import tempfile
+
+
+class TokenProvider:
+    """Bearer token provider for one scope that reuses its token and renews it `margin` seconds
+    before it expires, so requests never wait on an expired token."""
+
+    def __init__(self, credential, scope, margin=300):
+        self.credential = credential
+        self.scope = scope
+        self.margin = margin
+        self._token = None
+        self._lock = asyncio.Lock()
+
+    def _fresh(self) -> bool:
+        return self._token is not None and self._token.expires_on - time.time() > self.margin
+
+    async def __call__(self) -> str:
+        if not self._fresh():
+            async with self._lock:
+                if not self._fresh():
+                    self._token = await self.credential.get_token(self.scope)
+        return self._token.token
+
+
+class ClientResources:
+    """Credential and connection pools shared by the Azure clients of one worker process.
+
+    Each service gets its own keep-alive pool, sized with AZURE_SEARCH_POOL_SIZE,
+    AZURE_COSMOS_POOL_SIZE and AZURE_OPENAI_POOL_SIZE; idle connections are kept for
+    HTTP_KEEPALIVE_TIMEOUT seconds. Everything is created on first use and closed by `close`.
+    """
+
+    def __init__(self):
+        self.keepalive_timeout = int(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+        self.pool_sizes = {
+            "search": int(os.getenv("AZURE_SEARCH_POOL_SIZE", "100")),
+            "cosmos": int(os.getenv("AZURE_COSMOS_POOL_SIZE", "100")),
+            "openai": int(os.getenv("AZURE_OPENAI_POOL_SIZE", "100")),
+        }
+        self._credential = None
+        self._token_providers = {}
+        self._sessions = {}
+        self._http_client = None
+
+    def credential(self) -> DefaultAzureCredential:
+        if self._credential is None:
+            self._credential = DefaultAzureCredential()
+        return self._credential
+
+    async def token_provider(self, scope) -> TokenProvider:
+        provider = self._token_providers.get(scope)
+        if provider is None:
+            provider = self._token_providers[scope] = TokenProvider(self.credential(), scope)
+            # fetch the first token now instead of on the first request
+            await provider()
+        return provider
+
+    def transport(self, service) -> AioHttpTransport:
+        # azure sdk transport over a pooled session that the sdk clients do not close
+        session = self._sessions.get(service)
+        if session is None:
+            size = self.pool_sizes[service]
+            connector = aiohttp.TCPConnector(limit=size, limit_per_host=size, keepalive_timeout=self.keepalive_timeout, ttl_dns_cache=300)
+            session = self._sessions[service] = aiohttp.ClientSession(connector=connector)
+        return AioHttpTransport(session=session, session_owner=False)
+
+    def http_client(self) -> httpx.AsyncClient:
+        if self._http_client is None:
+            size = self.pool_sizes["openai"]
+            self._http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=size, max_keepalive_connections=size, keepalive_expiry=self.keepalive_timeout),
+                timeout=httpx.Timeout(float(os.getenv("AZURE_OPENAI_TIMEOUT", "600")), connect=5.0),
+            )
+        return self._http_client
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions = {}
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+        if self._credential is not None:
+            await self._credential.close()
+            self._credential = None
+        self._token_providers = {}
+
+
+# Shared cache backend, selected with CACHE_BACKEND=memory|sqlite|redis|none
+def init_cache_backend(namespace, *, maxsize, ttl) -> CacheBackend:
+    backend = os.getenv("CACHE_BACKEND", "memory").lower()
+    if maxsize <= 0 or backend == "none":
+        return None
+
+    if backend == "sqlite":
+        path = os.getenv(
+            "CACHE_SQLITE_PATH",
+            os.path.join(tempfile.gettempdir(), "assistant-cache.sqlite3"),
+        )
+        return SQLiteCache(path, table=namespace, maxsize=maxsize, ttl=ttl)
+
+    if backend == "redis":
+        url = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+        return RedisCache(url, prefix=f"{namespace}:", ttl=ttl, name=namespace)
+
+    return TTLCache(maxsize=maxsize, ttl=ttl, name=namespace)
+
+
+# Message events for server-sent events; shared through redis when CACHE_BACKEND=redis, or with
+# MESSAGE_BROKER=redis|memory
+def init_message_broker() -> MessageBroker:
+    default = "redis" if os.getenv("CACHE_BACKEND", "memory").lower() == "redis" else "memory"
+    if os.getenv("MESSAGE_BROKER", default).lower() == "redis":
+        url = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+        return RedisMessageBroker(url)
+    return MessageBroker()
+
+
+def init_client_resources() -> ClientResources:
+    return ClientResources()
+
 
 # Initialize Azure OpenAI Client
-async def init_openai_client() -> AsyncAzureOpenAI:
+async def init_openai_client(resources: ClientResources) -> AsyncAzureOpenAI:
     azure_openai_client = None
 
     try:
@@ -17,10 +147,7 @@ async def init_openai_client() -> AsyncAzureOpenAI:
         ad_token_provider = None
         if not aoai_api_key:
             logging.debug("No AZURE_OPENAI_KEY found, using Azure Entra ID auth")
-            async with DefaultAzureCredential() as credential:
-                ad_token_provider = get_bearer_token_provider(
-                    credential, "https://cognitiveservices.azure.com/.default"
-                )
+            ad_token_provider = await resources.token_provider("https://cognitiveservices.azure.com/.default")
 
         # Deployment
         deployment = os.getenv("AZURE_OPENAI_MODEL")
@@ -40,6 +167,7 @@ async def init_openai_client() -> AsyncAzureOpenAI:
             azure_ad_token_provider=ad_token_provider,
             default_headers=default_headers,
             azure_endpoint=endpoint,
+            http_client=resources.http_client(),
         )
 
         return azure_openai_client
@@ -49,7 +177,28 @@ async def init_openai_client() -> AsyncAzureOpenAI:
         raise e
 
 
-async def init_cosmosdb_conversation_client():
+
+# Opt-in cache of assistant answers, enabled with RESPONSE_CACHE=true
+def init_response_cache(openai_client) -> ResponseCache:
+    if os.getenv("RESPONSE_CACHE", "false").lower() not in ("true", "1"):
+        return None
+
+    cache_size = int(os.getenv("RESPONSE_CACHE_SIZE", "2048"))
+    cache_ttl = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+    backend = init_cache_backend("response", maxsize=cache_size, ttl=cache_ttl)
+    if backend is None:
+        return None
+
+    # near-duplicate questions are matched by embedding only if an embedding deployment is set
+    embedding_model = os.getenv("RESPONSE_CACHE_EMBEDDING_MODEL")
+    return ResponseCache(
+        backend,
+        embedding_client=openai_client if embedding_model else None,
+        embedding_model=embedding_model,
+        similarity=float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.95")),
+    )
+
+async def init_cosmosdb_conversation_client(resources: ClientResources):
     cosmos_conversation_client = None
     try:
         cosmos_service = os.getenv("AZURE_COSMOS_SERVICE")
@@ -61,8 +210,7 @@ async def init_cosmosdb_conversation_client():
         cosmos_endpoint = f"https://{cosmos_service}.documents.azure.com:443/"
 
         if not cosmos_key:
-            async with DefaultAzureCredential() as cred:
-                credential = cred
+            credential = resources.credential()
         else:
             credential = cosmos_key
 
@@ -76,11 +224,26 @@ async def init_cosmosdb_conversation_client():
         if not cosmos_conversation_container_name:
             raise ValueError("AZURE_COSMOS_CONVERSATION_CONTAINER is required")
 
+        # conversation headers only; a header deleted by one worker must not be served by another,
+        # so they are only cached in a shared backend
+        cache_size = int(os.getenv("CONVERSATION_CACHE_SIZE", "4096"))
+        cache_ttl = int(os.getenv("CONVERSATION_CACHE_TTL", "60"))
+        cache = init_cache_backend("conversation", maxsize=cache_size, ttl=cache_ttl)
+        if cache is not None and not cache.shared:
+            logging.info("Conversation cache disabled, it needs CACHE_BACKEND=redis")
+            await cache.close()
+            cache = None
+
         cosmos_conversation_client = CosmosConversationClient(
             cosmosdb_endpoint=cosmos_endpoint,
             credential=credential,
             database_name=cosmos_db_name,
             container_name=cosmos_conversation_container_name,
+            cache=cache,
+            delete_concurrency=int(os.getenv("AZURE_COSMOS_DELETE_CONCURRENCY", "8")),
+            transport=resources.transport("cosmos"),
+            # set to false after running `python -m src.cosmos_client`, which backfills lookups
+            lookup_fallback=os.getenv("AZURE_COSMOS_LOOKUP_FALLBACK", "true").lower() in ("true", "1"),
         )
     except Exception as e:
         logging.exception("Exception in CosmosDB initialization", e)
@@ -90,7 +253,8 @@ async def init_cosmosdb_conversation_client():
     return cosmos_conversation_client
 
 
-async def init_search_client():
+# without resources the search client uses its own transport, e.g. in batch jobs
+async def init_search_client(resources: ClientResources = None):
     try:
         ENDPOINT = os.getenv("AZURE_SEARCH_SERVICE")
         if not ENDPOINT:
@@ -105,10 +269,38 @@ async def init_search_client():
         if not KEY:
             raise ValueError("AZURE_SEARCH_KEY is required")
 
+        MATCH_CONCURRENCY = int(os.getenv("AZURE_SEARCH_MATCH_CONCURRENCY", "1"))
+        MATCH_STRATEGY = os.getenv("AZURE_SEARCH_MATCH_STRATEGY", "ladder")
+
+        # comma separated field list; unset uses the default projection, "*" fetches whole documents
+        SELECT_FIELDS = os.getenv("AZURE_SEARCH_SELECT_FIELDS")
+        if SELECT_FIELDS is not None:
+            SELECT_FIELDS = [] if SELECT_FIELDS.strip() == "*" else [f.strip() for f in SELECT_FIELDS.split(",") if f.strip()]
+
+        # SEARCH_CACHE_SIZE=0 disables the result cache
+        CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))
+        CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "900"))
+        cache = init_cache_backend("search", maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+
         return AISearchClient(
             ENDPOINT,
             INDEX,
             KEY,
+            match_concurrency=MATCH_CONCURRENCY,
+            match_strategy=MATCH_STRATEGY,
+            select_fields=SELECT_FIELDS,
+            cache=cache,
+            mandatory_weight=float(os.getenv("SEARCH_MANDATORY_WEIGHT", "1")),
+            removeable_weight=float(os.getenv("SEARCH_REMOVEABLE_WEIGHT", "1")),
+            snapshot_source=os.getenv("AZURE_SEARCH_SNAPSHOT") or None,
+            snapshot_refresh=int(os.getenv("AZURE_SEARCH_SNAPSHOT_REFRESH", "3600")),
+            match_mode=os.getenv("AZURE_SEARCH_MATCH_MODE", "ladder"),
+            hybrid_k=int(os.getenv("AZURE_SEARCH_HYBRID_K", "50")),
+            hybrid_weight=float(os.getenv("AZURE_SEARCH_HYBRID_WEIGHT", "0.5")),
+            nearest_path=os.getenv("NEAREST_TABLE_PATH") or None,
+            nearest_refresh=int(os.getenv("NEAREST_TABLE_REFRESH", "300")),
+            nearest_max_age=int(os.getenv("NEAREST_TABLE_MAX_AGE", "604800")),
+            transport=resources.transport("search") if resources else None,
         )
 
     except Exception as e:
@@ -1,7 +1,16 @@
+import asyncio
+import logging
+import re
 from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorizableTextQuery
 import json
+from src.cache import CacheBackend
+from src.scoring import BatchScorer
+from src.matching import MatchAccumulator
+from src.snapshot import ChassisSnapshot
+from src.nearest import NearestTable
+from src.metrics import timed
 
 
 
@@ -76,67 +85,387 @@ class AISearchClient:
         
         return default_search_keys
     
-    def __init__(self, search_endpoint, search_index_name, search_key):
+    # fields read by the prompt builder and the search results table, on top of the search keys
+    result_fields = ["ID", "description", "division", "chassis_number", "defects", "links"]
+
+    def default_select_fields(self) -> list[str]:
+        return self.result_fields + [key['name'] for key in self.search_keys(extended=True)]
+
+    # "ladder" relaxes keyword criteria one at a time, "vector" ranks by description embedding,
+    # "hybrid" runs one filtered keyword + vector query and falls back to the ladder
+    match_modes = ["ladder", "vector", "hybrid"]
+
+    def __init__(self, search_endpoint, search_index_name, search_key, *, match_concurrency=1, match_strategy="ladder", select_fields=None, cache: CacheBackend = None, mandatory_weight=1.0, removeable_weight=1.0, snapshot_source=None, snapshot_refresh=0, match_mode="ladder", hybrid_k=50, hybrid_weight=0.5, nearest_path=None, nearest_refresh=0, nearest_max_age=0, transport=None):
         self.service_endpoint = search_endpoint
         self.index_name = search_index_name
         self.key = search_key
+        # transport: an optional shared http transport, see src.ClientResources
         self.search_client = SearchClient(
-            self.service_endpoint, self.index_name, AzureKeyCredential(self.key)
+            self.service_endpoint, self.index_name, AzureKeyCredential(self.key), transport=transport
         )
+        # number of relaxation levels searched concurrently; 1 keeps the sequential behaviour
+        self.match_concurrency = match_concurrency
+        # "ladder" fetches every relaxation level in order, "probe" skips ahead using count-only queries
+        self.match_strategy = match_strategy
+        # projection applied to every document fetch; None means the default fields, [] fetches whole documents
+        if select_fields is None:
+            select_fields = self.default_select_fields()
+        self.select_fields = select_fields or None
+        # chassis documents and match results; None disables caching
+        self.cache = cache
+        # relative weight of mandatory and removeable keys in the matching score
+        self.mandatory_weight = mandatory_weight
+        self.removeable_weight = removeable_weight
+        # optional local matching engine: an export file path, or "index" to page through the index;
+        # matching runs against self.snapshot once load_snapshot() has been called
+        self.snapshot_source = snapshot_source
+        self.snapshot_refresh = snapshot_refresh
+        self.snapshot: ChassisSnapshot = None
+        self._snapshot_task = None
+        # default matching mode; hybrid recalls hybrid_k nearest neighbours and fuses the search
+        # ranking with the attribute score ranking, hybrid_weight being the share of the former
+        if match_mode not in self.match_modes:
+            raise ValueError(f"Unknown match mode {match_mode}")
+        self.match_mode = match_mode
+        self.hybrid_k = hybrid_k
+        self.hybrid_weight = hybrid_weight
+        # optional precomputed default matches (see src/nearest.py), checked for a new version
+        # every nearest_refresh seconds once start_nearest_refresh() has been called; rows older
+        # than nearest_max_age seconds are matched live (0 keeps them forever)
+        self.nearest_path = nearest_path
+        self.nearest_refresh = nearest_refresh
+        self.nearest_max_age = nearest_max_age
+        self.nearest: NearestTable = None
+        self._nearest_task = None
+
+    async def load_snapshot(self):
+        """(Re)build the local snapshot from the configured export file, or from the index itself."""
+        key_names = [key['name'] for key in self.search_keys(extended=True)]
+        if self.snapshot_source == "index":
+            snapshot = await ChassisSnapshot.dump_index(self.search_client, key_names, select=self.select_fields)
+        else:
+            snapshot = await asyncio.to_thread(ChassisSnapshot.load, self.snapshot_source, key_names, self.select_fields)
+        self.snapshot = snapshot
+        logging.info(f"Loaded chassis snapshot with {snapshot.size} documents from {self.snapshot_source}")
+
+    def start_snapshot_refresh(self):
+        async def refresh():
+            while True:
+                await asyncio.sleep(self.snapshot_refresh)
+                try:
+                    await self.load_snapshot()
+                except Exception:
+                    logging.exception("Failed to refresh chassis snapshot, keeping the previous one")
+
+        if self.snapshot_refresh and self._snapshot_task is None:
+            self._snapshot_task = asyncio.create_task(refresh())
+
+    async def load_nearest(self):
+        table = await asyncio.to_thread(NearestTable.load, self.nearest_path)
+        if table is None:
+            logging.warning(f"No nearest table at {self.nearest_path}, matching live")
+            return
+        self.nearest = table
+        logging.info(f"Loaded nearest table version {table.version} with {len(table)} chassis")
+
+    def start_nearest_refresh(self):
+        async def refresh():
+            while True:
+                await asyncio.sleep(self.nearest_refresh)
+                try:
+                    if self.nearest is None or self.nearest.changed():
+                        await self.load_nearest()
+                except Exception:
+                    logging.exception("Failed to reload the nearest table, keeping the previous one")
+
+        if self.nearest_refresh and self._nearest_task is None:
+            self._nearest_task = asyncio.create_task(refresh())
 
-    def get_chassis_by_id(self, chassis_id)->dict:
-        results = self.search_client.search(
+    async def close(self):
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            self._snapshot_task = None
+        if self._nearest_task is not None:
+            self._nearest_task.cancel()
+            self._nearest_task = None
+        await self.search_client.close()
+        if self.cache is not None:
+            await self.cache.close()
+
+    @timed("search.chassis")
+    async def get_chassis_by_id(self, chassis_id, *, cache_ttl=None)->dict:
+        snapshot = self.snapshot
+        if snapshot is not None:
+            chassis = snapshot.get(chassis_id)
+            if chassis is not None:
+                return chassis
+            # indexed since the snapshot was loaded
+
+        cache_key = f"chassis:{chassis_id}"
+        if self.cache is not None:
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        results = await self.search_client.search(
             search_text=chassis_id,
             skip=0,
             search_fields=["ID"],
+            select=self.select_fields,
             include_total_count=True,
         )
         
-        count = results.get_count()
+        count = await results.get_count()
         if count != 1:
             raise ValueError(f"Expected 1 result, got {count} results.")
         
-        for item in results:
+        async for item in results:
+            if self.cache is not None:
+                await self.cache.set(cache_key, item, ttl=cache_ttl)
             return item
 
         return None
 
-    def calculate_matching_score(self, chassis1, chassis2, *, scoring_search_keys=[]) -> float:
-        match_count = 0
-        total_count = 0
+    async def get_chassis_by_ids(self, chassis_ids) -> list[dict]:
+        """Documents of the given chassis in the given order, with one search for the uncached ones;
+        unknown IDs are left out."""
+        found = {}
+        snapshot = self.snapshot
+        if snapshot is not None:
+            for chassis_id in chassis_ids:
+                chassis = snapshot.get(chassis_id)
+                if chassis is not None:
+                    found[chassis_id] = chassis
+
+        if self.cache is not None:
+            for chassis_id in chassis_ids:
+                if chassis_id in found:
+                    continue
+                cached = await self.cache.get(f"chassis:{chassis_id}")
+                if cached is not None:
+                    found[chassis_id] = cached
+
+        missing = [chassis_id for chassis_id in chassis_ids if chassis_id not in found]
+        if missing:
+            id_list = self._odata_literal(",".join(missing))
+            iterator = await self.search_client.search(
+                search_text="*",
+                filter=f"search.in(ID, {id_list}, ',')",
+                select=self.select_fields,
+                top=len(missing),
+            )
+            async for item in iterator:
+                found[item["ID"]] = item
+                if self.cache is not None:
+                    await self.cache.set(f"chassis:{item['ID']}", item)
+
+        return [dict(found[chassis_id]) for chassis_id in chassis_ids if chassis_id in found]
+
+    async def has_cached_match(self, chassis_id, count_needed=10, mode=None) -> bool:
+        if self.cache is None:
+            return False
+        # not a lookup, so it is left out of the cache hit ratio
+        return await self.cache.contains(self._match_cache_key(chassis_id, None, count_needed, mode or self.match_mode))
+
+    async def _precomputed_matches(self, chassis_id, count_needed, mode) -> list[dict]:
+        table = self.nearest
+        if table is None or table.mode != mode or table.count != count_needed:
+            return None
+        found = table.lookup(chassis_id, self.nearest_max_age)
+        if found is None:
+            return None
+        scores = dict(found)
+        results = await self.get_chassis_by_ids([match_id for match_id, _ in found])
+        for result in results:
+            result["_score"] = scores[result["ID"]]
+        return results
+
+    def scorer(self, base_chassis, scoring_search_keys=[]) -> BatchScorer:
         if len(scoring_search_keys)==0:
             scoring_search_keys = self.search_keys()
-            
-        scoring_search_keys = [key['name'] for key in scoring_search_keys]
-            
-        for key in scoring_search_keys:
-            if chassis1.get(key) == chassis2.get(key):
-                match_count += 1
-            total_count += 1
-        return match_count / total_count
-
-    def get_matching_chassis(self, chassis_id, count_needed=10) -> list[dict]:
-        alg = 1
-        if alg == 1:
-            return self._get_matching_chassis_iterative(chassis_id, count_needed)
+        return BatchScorer(
+            base_chassis, scoring_search_keys,
+            mandatory_weight=self.mandatory_weight,
+            removeable_weight=self.removeable_weight,
+        )
+
+    def calculate_matching_score(self, chassis1, chassis2, *, scoring_search_keys=[]) -> float:
+        return self.scorer(chassis2, scoring_search_keys).score([chassis1])[0]
+
+    def _match_cache_key(self, chassis_id, search_keys, count_needed, mode) -> str:
+        # key order matters: removeable keys are relaxed in the order they are given
+        if search_keys is None:
+            keys = "default"
         else:
-            return self._get_matching_chassis_vector(chassis_id, count_needed)
+            keys = ",".join(f"{k['name']}{'!' if k['mandatory'] else ''}" for k in search_keys)
+        return f"match:{mode}:{chassis_id}:{count_needed}:{keys}"
+
+    @timed("search.match")
+    async def get_matching_chassis(self, chassis_id, count_needed=10, *, concurrency=None, strategy=None, mode=None, cache_ttl=None) -> list[dict]:
+        # cache_ttl overrides the cache's default ttl, e.g. for prewarmed entries
+        mode = mode or self.match_mode
+        cache_key = self._match_cache_key(chassis_id, None, count_needed, mode)
+        if self.cache is not None:
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        results = await self._precomputed_matches(chassis_id, count_needed, mode)
+        if results is None:
+            if mode == "vector":
+                results = await self._get_matching_chassis_vector(chassis_id, count_needed)
+            elif mode == "hybrid":
+                results = await self._get_matching_chassis_hybrid(chassis_id, count_needed, concurrency=concurrency, strategy=strategy)
+            else:
+                results = await self._get_matching_chassis_iterative(chassis_id, count_needed, concurrency=concurrency, strategy=strategy)
+
+        if self.cache is not None:
+            await self.cache.set(cache_key, results, ttl=cache_ttl)
+        return results
     
-    def get_matching_chassis_custom(self, chassis_id:str, search_keys:list[dict], count_needed=None) -> list[dict]:
+    @timed("search.match_custom")
+    async def get_matching_chassis_custom(self, chassis_id:str, search_keys:list[dict], count_needed=None, *, concurrency=None, strategy=None, mode=None) -> list[dict]:
         if count_needed is None:
             count_needed = 10
+        mode = mode or self.match_mode
+
+        cache_key = self._match_cache_key(chassis_id, search_keys, count_needed, mode)
+        if self.cache is not None:
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
+                return cached
         
         mandatory=[k for k in search_keys if k['mandatory']==True]
         removeable=[k for k in search_keys if k['mandatory']==False]
-        return self._get_matching_chassis_iterative(
-            chassis_id, count_needed, 
-            mandatory_search_keys=mandatory, 
-            removeable_search_keys=removeable
-        )
+        if mode == "vector":
+            results = await self._get_matching_chassis_vector(chassis_id, count_needed)
+        else:
+            match = self._get_matching_chassis_hybrid if mode == "hybrid" else self._get_matching_chassis_iterative
+            results = await match(
+                chassis_id, count_needed,
+                mandatory_search_keys=mandatory,
+                removeable_search_keys=removeable,
+                concurrency=concurrency,
+                strategy=strategy,
+            )
+
+        if self.cache is not None:
+            await self.cache.set(cache_key, results)
+        return results
         
     
-    def _get_matching_chassis_iterative(self, chassis_id, count_needed,*, mandatory_search_keys=[],removeable_search_keys=[]) -> list[dict]:
-        chassis = self.get_chassis_by_id(chassis_id)
+    def _build_relaxation_ladder(self, chassis, mandatory_search_keys, removeable_search_keys) -> list[tuple[list, list]]:
+        # each level is (mandatory criteria, removeable criteria) as (key name, value) pairs;
+        # level i drops the first i removeable criteria; the last level (mandatory only) is kept only if non-empty
+        mandatory_search_criteria = [(key['name'], chassis[key['name']]) for key in mandatory_search_keys]
+        removeable_search_criteria = [(key['name'], chassis[key['name']]) for key in removeable_search_keys]
+
+        ladder = []
+        for i in range(len(removeable_search_criteria) + 1):
+            level = (mandatory_search_criteria, removeable_search_criteria[i:])
+            if level[0] or level[1]:
+                ladder.append(level)
+        return ladder
+
+    @staticmethod
+    def _odata_literal(value) -> str:
+        if value is None:
+            return "null"
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if isinstance(value, (int, float)):
+            return str(value)
+        return "'{}'".format(str(value).replace("'", "''"))
+
+    @staticmethod
+    def _escape_search_value(value) -> str:
+        # backslash-escape lucene operators and the quotes around the value
+        return re.sub(r"""([+\-&|!(){}\[\]^"'~*?:\\/])""", r"\\\1", str(value))
+
+    def _level_filter(self, level, exclude_id=None) -> str:
+        # mandatory criteria are exact, non-scoring filters; None when there are none
+        mandatory_search_criteria, _ = level
+        filters = [f"{name} eq {self._odata_literal(value)}" for name, value in mandatory_search_criteria]
+        if exclude_id is not None:
+            filters.append(f"ID ne {self._odata_literal(exclude_id)}")
+        return " and ".join(filters) or None
+
+    def _level_search_text(self, level, operator="+") -> str:
+        # only removeable criteria are searched; a mandatory-only level matches everything in the filter.
+        # "+" requires every clause, "|" any of them (search_mode does not relax a "+")
+        _, removeable_search_criteria = level
+        if not removeable_search_criteria:
+            return "*"
+        return f" {operator} ".join(f"{name}: '{self._escape_search_value(value)}'" for name, value in removeable_search_criteria)
+
+    @timed("search.level")
+    async def _search_level(self, level) -> tuple[int, list[dict]]:
+        snapshot = self.snapshot
+        if snapshot is not None:
+            results = snapshot.search(level[0] + level[1])
+            return len(results), results
+
+        iterator = await self.search_client.search(
+            search_text=self._level_search_text(level),
+            search_mode="all",
+            filter=self._level_filter(level),
+            skip=0,
+            select=self.select_fields,
+            include_total_count=True,
+        )
+
+        count = await iterator.get_count()
+        results = []
+        if count > 0:
+            async for result in iterator:
+                results.append(result)
+        return count, results
+
+    @timed("search.count")
+    async def _count_level(self, level, exclude_id) -> int:
+        snapshot = self.snapshot
+        if snapshot is not None:
+            return snapshot.count(level[0] + level[1], exclude_id=exclude_id)
+
+        iterator = await self.search_client.search(
+            search_text=self._level_search_text(level),
+            search_mode="all",
+            filter=self._level_filter(level, exclude_id),
+            top=0,
+            include_total_count=True,
+        )
+        return await iterator.get_count()
+
+    async def _probe_ladder(self, ladder, chassis_id, count_needed) -> tuple[int, int]:
+        """Binary-search the ladder with count-only queries.
+
+        Returns the first level with any match other than the base chassis and the first level
+        with at least count_needed of them. Relaxing a level only drops `all`-mode clauses, so
+        counts never shrink further down the ladder; levels before `first` contribute nothing.
+        """
+        counts = {}
+
+        async def count_at(level):
+            if level not in counts:
+                counts[level] = await self._count_level(ladder[level], chassis_id)
+            return counts[level]
+
+        async def first_level(target, lo):
+            hi = len(ladder)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if await count_at(mid) >= target:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            return lo
+
+        first = await first_level(1, 0)
+        last = await first_level(max(count_needed, 1), first)
+        return first, last
+
+    async def _get_matching_chassis_iterative(self, chassis_id, count_needed,*, mandatory_search_keys=[],removeable_search_keys=[], concurrency=None, strategy=None) -> list[dict]:
+        chassis = await self.get_chassis_by_id(chassis_id)
         if not chassis:
             return []
         
@@ -145,58 +474,115 @@ class AISearchClient:
         if len(mandatory_search_keys) ==0 and len(removeable_search_keys) == 0:
             removeable_search_keys = self.search_keys()
 
-        all_matched_chassis = []
-        mandatory_search_criteria = [ (f"{key['name']}: '{chassis[key['name']]}'",False) for key in mandatory_search_keys]
-        removeable_search_criteria = [ (f"{key['name']}: '{chassis[key['name']]}'",True) for key in removeable_search_keys]
-        search_criteria = mandatory_search_criteria + removeable_search_criteria
-        
-        def pop_first_removeable(search_criteria):
-            for i in range(len(search_criteria)):
-                if search_criteria[i][1]:
-                    search_criteria.pop(i)
-                    return search_criteria
-            return None
+        ladder = self._build_relaxation_ladder(chassis, mandatory_search_keys, removeable_search_keys)
 
-        while search_criteria:
-            search = " + ".join([x[0] for x in search_criteria])
+        if concurrency is None:
+            concurrency = self.match_concurrency
+        concurrency = max(1, concurrency)
+        if strategy is None:
+            strategy = self.match_strategy
 
-            iterator = self.search_client.search(
-                search_text=search,
-                search_mode="all",
-                skip=0,
-                include_total_count=True,
-            )
+        all_matched_chassis = MatchAccumulator()
+        scorer = self.scorer(chassis, scoring_search_keys)
 
-            count = iterator.get_count()
+        def accumulate(count, results) -> bool:
             if count > 0:
-                for result in iterator:
-                    if result["ID"] != chassis["ID"]:
-                        result["_score"] = self.calculate_matching_score(
-                            result, chassis, 
-                            scoring_search_keys=scoring_search_keys
-                        )
-                        if result['ID'] not in [m['ID'] for m in all_matched_chassis]:
-                            all_matched_chassis.append(result)
+                results = [result for result in results if result["ID"] != chassis["ID"]]
+                for result, score in zip(results, scorer.score(results)):
+                    result["_score"] = score
+                    all_matched_chassis.add(result)
                 if len(all_matched_chassis) >= count_needed:
-                    break  
-                
-            search_criteria= pop_first_removeable(search_criteria)
-            if search_criteria is None:
-                break
-
-
-        filtered_list = []
-        for c in all_matched_chassis:
-            filtered_list_ids = [f["ID"] for f in filtered_list]
-            if c['ID'] not in filtered_list_ids:
-                filtered_list.append(c)
-                
-        filtered_list = sorted(filtered_list, key=lambda x: x["_score"], reverse=True)
-                
-        return filtered_list[:count_needed]
-
-    def _get_matching_chassis_vector(self, chassis_id, count_needed) -> list[dict]:
-        chassis = self.get_chassis_by_id(chassis_id)
+                    return True
+            return False
+
+        # Levels are searched in waves of `concurrency` queries, but consumed strictly in ladder
+        # order, so the first level that satisfies count_needed wins exactly as in a sequential walk.
+        start, stop = 0, len(ladder)
+        if strategy == "probe":
+            # levels before `first` match nothing and `last` is the first with enough matches
+            first, last = await self._probe_ladder(ladder, chassis["ID"], count_needed)
+            start, stop = first, last + 1
+
+        wave_start = start
+        done = False
+        while not done and wave_start < len(ladder):
+            wave_end = wave_start + concurrency
+            if wave_start < stop:
+                wave_end = min(wave_end, stop)
+            wave_results = await asyncio.gather(*[self._search_level(level) for level in ladder[wave_start:wave_end]])
+
+            for count, results in wave_results:
+                if accumulate(count, results):
+                    done = True
+                    break
+            wave_start = wave_end
+
+        return all_matched_chassis.top(count_needed)
+
+    @timed("search.hybrid")
+    async def _get_matching_chassis_hybrid(self, chassis_id, count_needed, *, mandatory_search_keys=[], removeable_search_keys=[], concurrency=None, strategy=None) -> list[dict]:
+        """One query combining a filter on the mandatory keys, keyword search on the other keys and
+        approximate vector recall on the description. Results are ordered by reciprocal rank
+        fusion of the search ranking and the attribute score ranking. Falls back to the relaxation
+        ladder when the filter leaves fewer than count_needed chassis.
+        """
+        chassis = await self.get_chassis_by_id(chassis_id)
+        if not chassis:
+            return []
+
+        scoring_search_keys = mandatory_search_keys + removeable_search_keys
+        filter_keys, keyword_keys = mandatory_search_keys, removeable_search_keys
+        if len(scoring_search_keys) == 0:
+            # default keys: the broad ones are hard requirements, the top ones rank
+            filter_keys = self.search_keys(broad=True)
+            broad = {key['name'] for key in filter_keys}
+            keyword_keys = [key for key in self.search_keys() if key['name'] not in broad]
+
+        level = (
+            [(key['name'], chassis.get(key['name'])) for key in filter_keys],
+            [(key['name'], chassis.get(key['name'])) for key in keyword_keys],
+        )
+
+        top = max(self.hybrid_k, count_needed)
+        vector_query = VectorizableTextQuery(text=chassis["description"], k_nearest_neighbors=top, fields="embedding", exhaustive=False)
+        iterator = await self.search_client.search(
+            # any matching key ranks a chassis, the more the better
+            search_text=self._level_search_text(level, "|"),
+            search_mode="any",
+            vector_queries=[vector_query],
+            filter=self._level_filter(level, chassis["ID"]),
+            select=self.select_fields,
+            top=top,
+        )
+        results = [result async for result in iterator]
+
+        if len(results) < count_needed:
+            logging.debug(f"hybrid match for {chassis_id} found {len(results)} of {count_needed}, relaxing")
+            return await self._get_matching_chassis_iterative(
+                chassis_id, count_needed,
+                mandatory_search_keys=mandatory_search_keys,
+                removeable_search_keys=removeable_search_keys,
+                concurrency=concurrency,
+                strategy=strategy,
+            )
+
+        for result, score in zip(results, self.scorer(chassis, scoring_search_keys).score(results)):
+            result["_score"] = score
+
+        # results come back in search order; rank them by attribute score too and fuse the ranks
+        rrf_k = 60
+        by_score = sorted(range(len(results)), key=lambda i: results[i]["_score"], reverse=True)
+        score_rank = {i: rank for rank, i in enumerate(by_score)}
+        fused = [
+            self.hybrid_weight / (rrf_k + i) + (1 - self.hybrid_weight) / (rrf_k + score_rank[i])
+            for i in range(len(results))
+        ]
+        order = sorted(range(len(results)), key=lambda i: fused[i], reverse=True)
+        return [results[i] for i in order[:count_needed]]
+
+    @timed("search.vector")
+    async def _get_matching_chassis_vector(self, chassis_id, count_needed) -> list[dict]:
+        chassis = await self.get_chassis_by_id(chassis_id)
         if not chassis:
             return []
        
@@ -204,23 +590,21 @@ class AISearchClient:
  
         vector_query = VectorizableTextQuery(text=description, k_nearest_neighbors=150, fields="embedding", exhaustive=True)
  
-        print(vector_query)
+        logging.debug(f"vector query for chassis {chassis_id}: {vector_query}")
        
-        iterator = self.search_client.search(  
+        iterator = await self.search_client.search(  
             #search_text=query,  
             vector_queries= [vector_query],
-            #select=["ID", "division", "dealer", "chassis_number"],
+            select=self.select_fields,
             top=150
         )  
  
-        all_matched_chassis = []
-        for result in iterator:  
-            if result["ID"] != chassis["ID"]:
-                score = self.calculate_matching_score(result, chassis)
-                result["_score"] = score
-                if result['ID'] not in [m['ID'] for m in all_matched_chassis]:
-                            all_matched_chassis.append(result)
-               
-        filtered_list = sorted(all_matched_chassis, key=lambda x: x["_score"], reverse=True)
-               
-        return filtered_list[:count_needed]
\ No newline at end of file
+        results = [result async for result in iterator if result["ID"] != chassis["ID"]]
+        scores = self.scorer(chassis).score(results)
+
+        all_matched_chassis = MatchAccumulator()
+        for result, score in zip(results, scores):
+            result["_score"] = score
+            all_matched_chassis.add(result)
+
+        return all_matched_chassis.top(count_needed)
\ No newline at end of file
@@ -0,0 +1,259 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from src.metrics import CACHE_REQUESTS_TOTAL
+
+
+class CacheBackend:
+    """Key/value cache used by the search and cosmos clients.
+
+    Keys are strings and values must be JSON serializable so that shared backends can store them.
+    Methods are coroutines so that backends doing I/O never block the event loop.
+    """
+
+    # true when every worker of every instance sees the same entries, so a delete is seen by all
+    shared = False
+
+    def __init__(self, ttl=900, name="cache"):
+        self.ttl = ttl
+        # label of this cache's lookups in the metrics
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+    def _hit(self):
+        self.hits += 1
+        CACHE_REQUESTS_TOTAL.inc(cache=self.name, result="hit")
+
+    def _miss(self):
+        self.misses += 1
+        CACHE_REQUESTS_TOTAL.inc(cache=self.name, result="miss")
+
+    async def get(self, key, default=None):
+        raise NotImplementedError
+
+    async def contains(self, key) -> bool:
+        """Whether `key` has an unexpired entry; unlike `get` it is not counted as a hit or miss and
+        does not refresh the entry's recency."""
+        raise NotImplementedError
+
+    async def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    async def delete(self, key):
+        raise NotImplementedError
+
+    async def clear(self):
+        raise NotImplementedError
+
+    async def size(self) -> int:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    async def stats(self) -> dict:
+        return {
+            "backend": type(self).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": await self.size(),
+        }
+
+
+class TTLCache(CacheBackend):
+    """Bounded in-process cache with per-entry expiry and least-recently-used eviction.
+
+    Cached values are shared with callers, so they must be treated as read-only.
+    """
+
+    def __init__(self, maxsize=1024, ttl=900, name="cache"):
+        super().__init__(ttl=ttl, name=name)
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    async def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self._miss()
+            return default
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self._miss()
+            return default
+
+        self._data.move_to_end(key)
+        self._hit()
+        return value
+
+    async def contains(self, key) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[0] >= time.monotonic()
+
+    async def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def delete(self, key):
+        self._data.pop(key, None)
+
+    async def clear(self):
+        self._data.clear()
+
+    async def size(self) -> int:
+        return len(self._data)
+
+    async def stats(self) -> dict:
+        return {**await super().stats(), "maxsize": self.maxsize}
+
+
+class SQLiteCache(CacheBackend):
+    """Cache stored in a local SQLite file, shared by every worker process on the node.
+
+    Entries expire by wall-clock time. Queries run in a worker thread, since a write lock held by
+    another process can make them wait. Every maxsize/100 writes, expired entries are removed and
+    the least recently read ones are evicted down to maxsize, so the table can briefly exceed
+    maxsize by about 1% per process.
+    """
+
+    def __init__(self, path, table="cache", maxsize=10000, ttl=900):
+        super().__init__(ttl=ttl, name=table)
+        self.path = path
+        self.table = table
+        self.maxsize = maxsize
+        self._evict_every = max(1, maxsize // 100)
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed_at ON {table} (accessed_at)")
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] < now:
+                if row is not None:
+                    self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                return None
+            self._conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def _set(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now + ttl, now),
+            )
+            self._writes += 1
+            if self._writes >= self._evict_every:
+                self._writes = 0
+                self._evict(now)
+
+    def _evict(self, now):
+        self._conn.execute(f"DELETE FROM {self.table} WHERE expires_at < ?", (now,))
+        count = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        if count > self.maxsize:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY accessed_at LIMIT ?)",
+                (count - self.maxsize,),
+            )
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._conn.execute(sql, parameters).fetchall()
+
+    async def get(self, key, default=None):
+        raw = await asyncio.to_thread(self._get, key)
+        if raw is None:
+            self._miss()
+            return default
+        self._hit()
+        return json.loads(raw)
+
+    async def contains(self, key) -> bool:
+        rows = await asyncio.to_thread(
+            self._execute, f"SELECT 1 FROM {self.table} WHERE key = ? AND expires_at >= ?", (key, time.time())
+        )
+        return bool(rows)
+
+    async def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        await asyncio.to_thread(self._set, key, json.dumps(value), ttl)
+
+    async def delete(self, key):
+        await asyncio.to_thread(self._execute, f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    async def clear(self):
+        await asyncio.to_thread(self._execute, f"DELETE FROM {self.table}")
+
+    async def size(self) -> int:
+        rows = await asyncio.to_thread(self._execute, f"SELECT COUNT(*) FROM {self.table}")
+        return rows[0][0]
+
+    async def close(self):
+        self._conn.close()
+
+    async def stats(self) -> dict:
+        return {**await super().stats(), "maxsize": self.maxsize}
+
+
+class RedisCache(CacheBackend):
+    """Cache stored in a Redis compatible server, normally one running on the same node.
+
+    Eviction is left to the server (e.g. `maxmemory-policy allkeys-lru`); requires the `redis` package.
+    """
+
+    shared = True
+
+    def __init__(self, url, prefix="cache:", ttl=900, name="cache"):
+        import redis.asyncio as redis
+
+        super().__init__(ttl=ttl, name=name)
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, socket_timeout=1)
+
+    async def get(self, key, default=None):
+        raw = await self._client.get(self.prefix + key)
+        if raw is None:
+            self._miss()
+            return default
+        self._hit()
+        return json.loads(raw)
+
+    async def contains(self, key) -> bool:
+        return await self._client.exists(self.prefix + key) > 0
+
+    async def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        await self._client.set(self.prefix + key, json.dumps(value), ex=max(1, int(ttl)))
+
+    async def delete(self, key):
+        await self._client.delete(self.prefix + key)
+
+    async def clear(self):
+        keys = [key async for key in self._client.scan_iter(match=self.prefix + "*")]
+        if keys:
+            await self._client.delete(*keys)
+
+    async def size(self) -> int:
+        return len([key async for key in self._client.scan_iter(match=self.prefix + "*")])
+
+    async def close(self):
+        await self._client.aclose()
@@ -1,7 +1,33 @@
 import uuid
+import asyncio
+import hashlib
 from datetime import datetime
 from azure.cosmos.aio import CosmosClient
 from azure.cosmos import exceptions
+from azure.core import MatchConditions
+from src.cache import CacheBackend
+from src.metrics import timed, record_cosmos_response
+
+# fields returned when loading a conversation partition (header and messages)
+CONVERSATION_FIELDS = [
+    "id", "conversationId", "type", "timestamp",
+    "userId", "chassisId",
+    "messageId", "sender", "content", "state", "inResponseTo",
+    "liked", "references", "actions", "followupPrompts",
+    "results", "baseChassis", "query",
+]
+
+# maximum number of operations in a cosmos transactional batch
+BATCH_SIZE = 100
+
+# search document fields that are never written to cosmos
+EXCLUDED_CHASSIS_FIELDS = ["embedding"]
+
+
+def slim_chassis(chassis: dict) -> dict:
+    if not chassis:
+        return chassis
+    return {k: v for k, v in chassis.items() if k not in EXCLUDED_CHASSIS_FIELDS}
 
 
 class MyCosmosClient:
@@ -12,14 +38,23 @@ class MyCosmosClient:
         credential: any,
         database_name: str,
         container_name: str,
+        cache: CacheBackend = None,
+        delete_concurrency: int = 8,
+        transport=None,
+        lookup_fallback: bool = True,
     ):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
+        self.cache = cache
+        self.delete_concurrency = delete_concurrency
+        # query for conversations without a lookup document; off once backfill_lookups has run
+        self.lookup_fallback = lookup_fallback
         try:
+            # every response reports its request charge to the metrics
             self.cosmosdb_client = CosmosClient(
-                self.cosmosdb_endpoint, credential=credential
+                self.cosmosdb_endpoint, credential=credential, raw_response_hook=record_cosmos_response, transport=transport
             )
         except exceptions.CosmosHttpResponseError as e:
             if e.status_code == 401:
@@ -42,6 +77,11 @@ class MyCosmosClient:
             raise ValueError("Invalid CosmosDB container name")
         return
 
+    async def close(self):
+        await self.cosmosdb_client.close()
+        if self.cache is not None:
+            await self.cache.close()
+
     async def ensure(self):
         if (
             not self.cosmosdb_client
@@ -66,6 +106,149 @@ class MyCosmosClient:
 
 
 class CosmosConversationClient(MyCosmosClient):
+    # conversation headers never change after creation, so they are cached by id and by (user, chassis);
+    # a deleted one stays cached in other processes unless the cache is shared
+    async def _cache_conversation(self, conversation):
+        if self.cache is None:
+            return
+        header = {k: v for k, v in conversation.items() if k != "messages"}
+        await self.cache.set(f"conversation:{header['conversationId']}", header)
+        await self.cache.set(f"conversation_for:{header['userId']}:{header['chassisId']}", header)
+
+    async def _cached_conversation(self, key):
+        if self.cache is None:
+            return None
+        conversation = await self.cache.get(key)
+        if conversation is None:
+            return None
+        return dict(conversation)
+
+    async def _forget_conversation(self, conversation):
+        if self.cache is None:
+            return
+        await self.cache.delete(f"conversation:{conversation['conversationId']}")
+        await self.cache.delete(f"conversation_for:{conversation['userId']}:{conversation['chassisId']}")
+
+    # The (userId, chassisId) -> conversation lookup document lives in its own partition, so
+    # search_conversation is two point reads instead of a cross-partition query.
+    @staticmethod
+    def _lookup_id(user_id, chassis_id) -> str:
+        digest = hashlib.sha256(f"{user_id}\n{chassis_id}".encode("utf-8")).hexdigest()
+        return f"lookup-{digest}"
+
+    async def _read_item(self, item_id, partition_key):
+        try:
+            return await self.container_client.read_item(item=item_id, partition_key=partition_key)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    async def _delete_item(self, item_id, partition_key) -> bool:
+        try:
+            await self.container_client.delete_item(item_id, partition_key=partition_key)
+            return True
+        except exceptions.CosmosResourceNotFoundError:
+            return False
+
+    async def _read_conversation(self, conversation_id):
+        conversation = await self._cached_conversation(f"conversation:{conversation_id}")
+        if conversation is None:
+            # the header's id is its conversationId, which is also the partition key
+            conversation = await self._read_item(conversation_id, conversation_id)
+            if conversation is None or conversation.get("type") != "conversation":
+                return None
+            await self._cache_conversation(conversation)
+        return conversation
+
+    async def _upsert_lookup(self, conversation):
+        lookup_id = self._lookup_id(conversation["userId"], conversation["chassisId"])
+        await self.container_client.upsert_item({
+            "id": lookup_id,
+            "conversationId": lookup_id,
+            "type": "conversation_lookup",
+            "timestamp": int(datetime.now().timestamp()),
+            "userId": conversation["userId"],
+            "chassisId": conversation["chassisId"],
+            "targetConversationId": conversation["conversationId"],
+        })
+
+    async def _delete_lookup(self, conversation):
+        lookup_id = self._lookup_id(conversation["userId"], conversation["chassisId"])
+        lookup = await self._read_item(lookup_id, lookup_id)
+        if lookup and lookup["targetConversationId"] == conversation["conversationId"]:
+            await self._delete_item(lookup_id, lookup_id)
+
+    @timed("cosmos.backfill_lookups")
+    async def backfill_lookups(self, concurrency=8) -> dict:
+        """Create the missing lookup documents of existing conversations, the oldest conversation
+        of a (user, chassis) pair winning; existing lookups are left alone. Once this has run,
+        the fallback query in search_conversation can be turned off."""
+        query = "SELECT c.conversationId, c.userId, c.chassisId FROM c WHERE c.type = 'conversation' ORDER BY c.timestamp"
+        semaphore = asyncio.Semaphore(concurrency)
+        counts = {"conversations": 0, "created": 0, "existing": 0}
+        seen = set()
+
+        async def create(conversation):
+            lookup_id = self._lookup_id(conversation["userId"], conversation["chassisId"])
+            async with semaphore:
+                try:
+                    await self.container_client.create_item({
+                        "id": lookup_id,
+                        "conversationId": lookup_id,
+                        "type": "conversation_lookup",
+                        "timestamp": int(datetime.now().timestamp()),
+                        "userId": conversation["userId"],
+                        "chassisId": conversation["chassisId"],
+                        "targetConversationId": conversation["conversationId"],
+                    })
+                    counts["created"] += 1
+                except exceptions.CosmosResourceExistsError:
+                    counts["existing"] += 1
+
+        tasks = []
+        async for conversation in self.container_client.query_items(query):
+            counts["conversations"] += 1
+            pair = (conversation["userId"], conversation["chassisId"])
+            if pair in seen:
+                continue
+            seen.add(pair)
+            tasks.append(asyncio.create_task(create(conversation)))
+        await asyncio.gather(*tasks)
+        return counts
+
+    async def _load_partition(self, conversation_id, since=None, seen_ids=None):
+        """Read a conversation header and its messages with one single-partition query.
+
+        With `since` (a timestamp) only items at or after it are returned, which normally leaves
+        out the header; `seen_ids` drops items the caller already has, since timestamps are in
+        whole seconds.
+        """
+        fields = ", ".join(f"c.{field}" for field in CONVERSATION_FIELDS)
+        query = f"SELECT {fields} FROM c WHERE c.conversationId = @conversation_id"
+        parameters = [{"name": "@conversation_id", "value": conversation_id}]
+        if since is not None:
+            query += " AND c.timestamp >= @since"
+            parameters.append({"name": "@since", "value": since})
+        query += " ORDER BY c.timestamp"
+
+        conversation = None
+        msgs = []
+        async for item in self.container_client.query_items(
+            query, parameters=parameters, partition_key=conversation_id
+        ):
+            if seen_ids and item["id"] in seen_ids:
+                continue
+            if item["type"] == "conversation":
+                conversation = item
+            elif item["type"] == "message":
+                msgs.append(item)
+        return conversation, msgs
+
+    @timed("cosmos.load_messages")
+    async def load_messages(self, conversation_id, since=None, seen_ids=None):
+        _, msgs = await self._load_partition(conversation_id, since=since, seen_ids=seen_ids)
+        return msgs
+
+    @timed("cosmos.create_conversation")
     async def create_conversation(self, user_id, chassis_id):
         id = str(uuid.uuid4())
         conversation = {
@@ -79,55 +262,71 @@ class CosmosConversationClient(MyCosmosClient):
 
         resp = await self.container_client.upsert_item(conversation)
         if resp:
+            await self._upsert_lookup(resp)
+            await self._cache_conversation(resp)
             resp["messages"] = []
             return resp
         else:
             return False
 
+    @timed("cosmos.search_conversation")
     async def search_conversation(self, user_id, chassis_id):
-        query = f"SELECT * FROM c WHERE c.userId = '{user_id}' AND c.chassisId = '{chassis_id}' and c.type = 'conversation'"
-        conversation = None
-        async for item in self.container_client.query_items(query):
-            conversation = item
-            break
-
+        conversation = await self._cached_conversation(f"conversation_for:{user_id}:{chassis_id}")
         if conversation is None:
-            return None
+            lookup_id = self._lookup_id(user_id, chassis_id)
+            lookup = await self._read_item(lookup_id, lookup_id)
+            if lookup is not None:
+                conversation = await self._read_conversation(lookup["targetConversationId"])
+                if conversation is None:
+                    # the conversation was deleted without its lookup
+                    await self._delete_item(lookup_id, lookup_id)
+                    return None
+            elif self.lookup_fallback:
+                # conversations created before lookup documents existed
+                query = "SELECT * FROM c WHERE c.userId = @user_id AND c.chassisId = @chassis_id and c.type = 'conversation'"
+                async for item in self.container_client.query_items(
+                    query,
+                    parameters=[
+                        {"name": "@user_id", "value": user_id},
+                        {"name": "@chassis_id", "value": chassis_id},
+                    ],
+                ):
+                    conversation = item
+                    break
 
-        msgs = []
-        query = f"SELECT * FROM c WHERE c.conversationId = '{conversation['conversationId']}' and c.type = 'message'"
-        async for item in self.container_client.query_items(
-            query, partition_key=conversation["conversationId"]
-        ):
-            msgs.append(item)
+                if conversation is None:
+                    return None
+                await self._upsert_lookup(conversation)
+            else:
+                return None
+            await self._cache_conversation(conversation)
 
-        conversation["messages"] = sorted(msgs, key=lambda x: x["timestamp"])
+        conversation = dict(conversation)
+        conversation["messages"] = await self.load_messages(conversation["conversationId"])
         return conversation
 
+    @timed("cosmos.verify_conversation")
     async def verify_conversation(self, conversation_id, user_id, with_messages=False):
-        query = f"SELECT * FROM c WHERE c.conversationId = '{conversation_id}' and c.userId = '{user_id}' and c.type = 'conversation'"
-        conversation = None
-        async for item in self.container_client.query_items(query):
-            conversation = item
-            break
+        if with_messages:
+            conversation, msgs = await self._load_partition(conversation_id)
+            if conversation is None:
+                return None
+            await self._cache_conversation(conversation)
+        else:
+            conversation, msgs = await self._read_conversation(conversation_id), []
+            if conversation is None:
+                return None
+            conversation = dict(conversation)
 
-        if conversation is None:
+        if conversation["userId"] != user_id:
             return None
 
-        msgs = []
-        if with_messages:
-            query = f"SELECT * FROM c WHERE c.conversationId = '{conversation['conversationId']}' and c.type = 'message'"
-            async for item in self.container_client.query_items(
-                query, partition_key=conversation["conversationId"]
-            ):
-                msgs.append(item)
-
-        conversation["messages"] = sorted(msgs, key=lambda x: x["timestamp"])
+        conversation["messages"] = msgs
         return conversation
 
-    async def add_user_message(self, conversation_id, content):
+    def _new_user_message(self, conversation_id, content):
         id = str(uuid.uuid4())
-        message = {
+        return {
             "id": id,
             "messageId": id,
             "conversationId": conversation_id,
@@ -137,15 +336,9 @@ class CosmosConversationClient(MyCosmosClient):
             "content": content,
         }
 
-        resp = await self.container_client.upsert_item(message)
-        if resp:
-            return resp
-        else:
-            return False
-
-    async def add_assistant_message(self, conversation_id, in_response_to_id):
+    def _new_assistant_message(self, conversation_id, in_response_to_id):
         id = str(uuid.uuid4())
-        message = {
+        return {
             "id": id,
             "inResponseTo": in_response_to_id,
             "messageId": id,
@@ -161,27 +354,9 @@ class CosmosConversationClient(MyCosmosClient):
             "state": "pending",
         }
 
-        resp = await self.container_client.upsert_item(message)
-        if resp:
-            return resp
-        else:
-            return False
-
-    async def update_assistant_message(self, conversation_id, message_id, content):
-        resp = await self.container_client.read_item(
-            item=message_id, partition_key=conversation_id
-        )
-        if resp:
-            resp["content"] = content
-            resp["state"] = "completed"
-            resp = await self.container_client.upsert_item(resp)
-            return resp
-        else:
-            return False
-
-    async def add_search_results_message(self, conversation_id, base_chassis, results=[], query=""):
+    def _new_search_results_message(self, conversation_id, base_chassis, results=[], query=""):
         id = str(uuid.uuid4())
-        message = {
+        return {
             "id": id,
             "conversationId": conversation_id,
             "messageId": id,
@@ -189,20 +364,14 @@ class CosmosConversationClient(MyCosmosClient):
             "timestamp": int(datetime.now().timestamp()),
             "sender": "search_results",
             "content": "",
-            "results": results,
-            "baseChassis": base_chassis,
+            "results": [slim_chassis(r) for r in results],
+            "baseChassis": slim_chassis(base_chassis),
             "query": query,
         }
 
-        resp = await self.container_client.upsert_item(message)
-        if resp:
-            return resp
-        else:
-            return False
-    
-    async def add_search_request_message(self, conversation_id, search_keys=[]):
+    def _new_search_request_message(self, conversation_id, search_keys=[]):
         id = str(uuid.uuid4())
-        message = {
+        return {
             "id": id,
             "conversationId": conversation_id,
             "messageId": id,
@@ -213,23 +382,103 @@ class CosmosConversationClient(MyCosmosClient):
             "query": search_keys,
         }
 
-        resp = await self.container_client.upsert_item(message)
+    async def _upsert_batch(self, conversation_id, items) -> list[dict]:
+        # one transactional batch: all items of the partition are written, or none
+        results = await self.container_client.execute_item_batch(
+            [("upsert", (item,)) for item in items], partition_key=conversation_id
+        )
+        return [r["resourceBody"] for r in results]
+
+    @timed("cosmos.add_user_message")
+    async def add_user_message(self, conversation_id, content):
+        resp = await self.container_client.upsert_item(self._new_user_message(conversation_id, content))
         if resp:
             return resp
         else:
             return False
 
-    async def update_message_feedback(self, conversation_id, message_id, liked):
-        message = await self.container_client.read_item(
-            item=message_id, partition_key=conversation_id
+    @timed("cosmos.add_assistant_message")
+    async def add_assistant_message(self, conversation_id, in_response_to_id):
+        resp = await self.container_client.upsert_item(self._new_assistant_message(conversation_id, in_response_to_id))
+        if resp:
+            return resp
+        else:
+            return False
+
+    @timed("cosmos.add_message_pair")
+    async def add_message_pair(self, conversation_id, content):
+        """Write a user message and the pending assistant reply to it in one batch."""
+        user_msg = self._new_user_message(conversation_id, content)
+        assistant_msg = self._new_assistant_message(conversation_id, user_msg["id"])
+        return await self._upsert_batch(conversation_id, [user_msg, assistant_msg])
+
+    @timed("cosmos.add_search_messages")
+    async def add_search_messages(self, conversation_id, search_keys, base_chassis, results, requested_at=None):
+        """Write a search request and its results in one batch, once the search is done."""
+        request_msg = self._new_search_request_message(conversation_id, search_keys)
+        if requested_at is not None:
+            request_msg["timestamp"] = requested_at
+        results_msg = self._new_search_results_message(conversation_id, base_chassis, results)
+        return await self._upsert_batch(conversation_id, [request_msg, results_msg])
+
+    async def _patch_message(self, conversation_id, message_id, patch_operations, etag=None):
+        # with an etag the patch only applies if the message is unchanged since it was read,
+        # otherwise CosmosAccessConditionFailedError is raised
+        kwargs = {}
+        if etag:
+            kwargs = {"etag": etag, "match_condition": MatchConditions.IfNotModified}
+        try:
+            return await self.container_client.patch_item(
+                item=message_id,
+                partition_key=conversation_id,
+                patch_operations=patch_operations,
+                **kwargs,
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return False
+
+    @timed("cosmos.update_assistant_message")
+    async def update_assistant_message(self, conversation_id, message_id, content, state="completed", etag=None):
+        return await self._patch_message(
+            conversation_id,
+            message_id,
+            [
+                {"op": "set", "path": "/content", "value": content},
+                {"op": "set", "path": "/state", "value": state},
+            ],
+            etag=etag,
+        )
+
+    @timed("cosmos.add_search_results_message")
+    async def add_search_results_message(self, conversation_id, base_chassis, results=[], query=""):
+        resp = await self.container_client.upsert_item(
+            self._new_search_results_message(conversation_id, base_chassis, results, query)
+        )
+        if resp:
+            return resp
+        else:
+            return False
+    
+    @timed("cosmos.add_search_request_message")
+    async def add_search_request_message(self, conversation_id, search_keys=[]):
+        resp = await self.container_client.upsert_item(
+            self._new_search_request_message(conversation_id, search_keys)
         )
-        if message:
-            message["liked"] = liked
-            resp = await self.container_client.upsert_item(message)
+        if resp:
             return resp
         else:
             return False
 
+    @timed("cosmos.update_message_feedback")
+    async def update_message_feedback(self, conversation_id, message_id, liked, etag=None):
+        return await self._patch_message(
+            conversation_id,
+            message_id,
+            [{"op": "set", "path": "/liked", "value": liked}],
+            etag=etag,
+        )
+
+    @timed("cosmos.retrieve_message")
     async def retrieve_message(self, conversation_id, message_id):
         resp = await self.container_client.read_item(
             item=message_id, partition_key=conversation_id
@@ -239,31 +488,83 @@ class CosmosConversationClient(MyCosmosClient):
         else:
             return False
 
+    @timed("cosmos.delete_all_conversations")
     async def delete_all_conversations(self, user_id):
-        query = f"SELECT * FROM c WHERE c.type = 'conversation' and c.userId = '{user_id}'"
+        # the only lookup by user without a known conversation id, so it stays a cross-partition query
+        query = "SELECT c.conversationId FROM c WHERE c.type = 'conversation' and c.userId = @user_id"
         conversationIds = []
         deleteCount = {
             "conversation": 0,
             "message": 0,
         }
-        async for item in self.container_client.query_items(query):
+        async for item in self.container_client.query_items(
+            query, parameters=[{"name": "@user_id", "value": user_id}]
+        ):
             conversationIds.append(item["conversationId"])
-        for conversationId in conversationIds:
-            query = f"SELECT * FROM c WHERE c.conversationId = '{conversationId}'"
-            async for item in self.container_client.query_items(
-                query, partition_key=conversationId
-            ):
-                await self.container_client.delete_item(item, partition_key=conversationId)
-                deleteCount[item["type"]] += 1
+
+        # conversations are separate partitions, so they are deleted concurrently
+        semaphore = asyncio.Semaphore(self.delete_concurrency)
+
+        async def delete(conversationId):
+            async with semaphore:
+                return await self.delete_conversation(conversationId)
+
+        for counts in await asyncio.gather(*[delete(c) for c in conversationIds]):
+            for key in deleteCount:
+                deleteCount[key] += counts[key]
         return deleteCount
     
+    @timed("cosmos.delete_conversation")
     async def delete_conversation(self, conversation_id):
-        query = f"SELECT * FROM c WHERE c.conversationId = '{conversation_id}'"
+        query = "SELECT c.id, c.type, c.conversationId, c.userId, c.chassisId FROM c WHERE c.conversationId = @conversation_id"
         deleteCount = {
             "conversation": 0,
             "message": 0,
         }
-        async for item in self.container_client.query_items(query):
-            await self.container_client.delete_item(item, partition_key=conversation_id)
-            deleteCount[item["type"]] += 1
-        return deleteCount
\ No newline at end of file
+        items = []
+        async for item in self.container_client.query_items(
+            query,
+            parameters=[{"name": "@conversation_id", "value": conversation_id}],
+            partition_key=conversation_id,
+        ):
+            items.append(item)
+
+        for i in range(0, len(items), BATCH_SIZE):
+            chunk = items[i:i + BATCH_SIZE]
+            try:
+                await self.container_client.execute_item_batch(
+                    [("delete", (item["id"],)) for item in chunk], partition_key=conversation_id
+                )
+            except exceptions.CosmosBatchOperationError:
+                # e.g. an item deleted concurrently, which fails the whole batch
+                for item in chunk:
+                    await self._delete_item(item["id"], conversation_id)
+
+            for item in chunk:
+                if item["type"] == "conversation":
+                    await self._delete_lookup(item)
+                    await self._forget_conversation(item)
+                deleteCount[item["type"]] += 1
+        return deleteCount
+
+
+if __name__ == "__main__":
+    # one-time backfill of lookup documents; afterwards set AZURE_COSMOS_LOOKUP_FALLBACK=false
+    import json
+    import logging
+    from dotenv import load_dotenv
+
+    async def backfill():
+        from src import init_client_resources, init_cosmosdb_conversation_client
+
+        resources = init_client_resources()
+        client = await init_cosmosdb_conversation_client(resources)
+        try:
+            return await client.backfill_lookups()
+        finally:
+            await client.close()
+            await resources.close()
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    print(json.dumps(asyncio.run(backfill())))
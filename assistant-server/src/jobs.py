@@ -0,0 +1,108 @@
+import asyncio
+import contextvars
+import logging
+import random
+
+
+class JobScheduler:
+    """Runs background jobs of one worker process on a fixed number of worker tasks.
+
+    At most `concurrency` jobs run at once; up to `queue_size` more wait in the queue, after which
+    `submit` refuses new jobs so the caller can shed load. Each attempt of a job is limited to
+    `timeout` seconds. Exceptions listed in `retry_on` are retried up to `retries` times with
+    exponential backoff and full jitter. A job that still fails is handed to its `on_failure`
+    callback with the exception, as is every job cancelled or left in the queue by `drain`.
+    """
+
+    def __init__(self, *, concurrency=4, queue_size=100, timeout=120, retries=3, backoff=1.0, max_backoff=30.0, retry_on=()):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_on = tuple(retry_on)
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._workers = []
+        self._accepting = False
+
+    def start(self):
+        self._accepting = True
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    def full(self) -> bool:
+        return not self._accepting or self._queue.full()
+
+    def submit(self, job_id, job, on_failure=None) -> bool:
+        """Queue `job`, a callable returning a new coroutine for every attempt. Returns False if the
+        queue is full or the scheduler is shutting down."""
+        if not self._accepting:
+            return False
+        try:
+            # jobs run in the context they were submitted from, e.g. with its trace id
+            self._queue.put_nowait((job_id, job, on_failure, contextvars.copy_context()))
+        except asyncio.QueueFull:
+            logging.warning(f"Job queue full, rejecting job {job_id}")
+            return False
+        return True
+
+    def stats(self) -> dict:
+        return {"queued": self._queue.qsize(), "workers": len(self._workers), "accepting": self._accepting}
+
+    async def _worker(self):
+        while True:
+            job_id, job, on_failure, context = await self._queue.get()
+            try:
+                await context.run(asyncio.ensure_future, self._run(job_id, job, on_failure))
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id, job, on_failure):
+        attempt = 0
+        while True:
+            try:
+                await asyncio.wait_for(job(), self.timeout)
+                return
+            except asyncio.CancelledError as e:
+                logging.warning(f"Job {job_id} cancelled")
+                # finish marking the job failed even though this task is being cancelled
+                await asyncio.shield(self._fail(job_id, on_failure, e))
+                raise
+            except Exception as e:
+                if isinstance(e, self.retry_on) and attempt < self.retries:
+                    delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                    attempt += 1
+                    logging.warning(f"Job {job_id} failed with {type(e).__name__}, retry {attempt} in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    continue
+                if isinstance(e, asyncio.TimeoutError):
+                    logging.error(f"Job {job_id} timed out after {self.timeout}s")
+                else:
+                    logging.exception(f"Job {job_id} failed")
+                await self._fail(job_id, on_failure, e)
+                return
+
+    async def _fail(self, job_id, on_failure, error):
+        if on_failure:
+            try:
+                await on_failure(error)
+            except Exception:
+                logging.exception(f"Failure handler of job {job_id} failed")
+
+    async def drain(self, timeout=30):
+        """Stop accepting jobs, let queued and running jobs finish for up to `timeout` seconds, then
+        cancel whatever is left. Cancelled and still queued jobs are handed to `on_failure`."""
+        self._accepting = False
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"{self._queue.qsize()} jobs still pending at shutdown, cancelling")
+        dropped = []
+        while not self._queue.empty():
+            dropped.append(self._queue.get_nowait())
+            self._queue.task_done()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for job_id, job, on_failure, context in dropped:
+            await context.run(asyncio.ensure_future, self._fail(job_id, on_failure, asyncio.CancelledError()))
@@ -0,0 +1,29 @@
+import heapq
+
+
+class MatchAccumulator:
+    """Scored search results keyed by chassis ID, in the order they were first seen.
+
+    The first occurrence of an ID wins, as with the old list-based dedup. `top` returns the same
+    list as a stable descending sort by `_score` truncated to k, without sorting everything.
+    """
+
+    def __init__(self):
+        self._matches = {}
+
+    def __len__(self):
+        return len(self._matches)
+
+    def __contains__(self, chassis_id):
+        return chassis_id in self._matches
+
+    def add(self, result: dict) -> bool:
+        if result["ID"] in self._matches:
+            return False
+        self._matches[result["ID"]] = result
+        return True
+
+    def top(self, k: int) -> list[dict]:
+        if k <= 0:
+            return []
+        return heapq.nlargest(k, self._matches.values(), key=lambda x: x["_score"])
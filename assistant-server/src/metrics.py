@@ -0,0 +1,384 @@
+import asyncio
+import contextlib
+import fcntl
+import functools
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+
+# id of the http request being handled, shown in log lines as %(trace_id)s
+trace_id_var: ContextVar[str] = ContextVar("trace_id", default="-")
+# innermost `span` being timed, e.g. cosmos.verify_conversation; labels the cosmos charges
+stage_var: ContextVar[str] = ContextVar("stage", default="-")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def install_trace_ids():
+    """Adds the current trace id to every log record, so any handler's format can use it."""
+    factory = logging.getLogRecordFactory()
+    if getattr(factory, "adds_trace_id", False):
+        return
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.trace_id = trace_id_var.get()
+        return record
+
+    record_factory.adds_trace_id = True
+    logging.setLogRecordFactory(record_factory)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def series(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def render(self, series=None) -> list[str]:
+        if series is None:
+            series = self.series()
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(series.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket, sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def series(self) -> dict:
+        with self._lock:
+            return {key: [list(counts), total, count] for key, (counts, total, count) in self._series.items()}
+
+    @staticmethod
+    def merge(a, b):
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1], a[2] + b[2]]
+
+    def render(self, series=None) -> list[str]:
+        if series is None:
+            series = self.series()
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = _labels(self.labelnames, key, ['le="%s"' % bound])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _labels(self.labelnames, key, ['le="+Inf"'])
+            lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class HitRatio:
+    """Gauge computed when rendering from a counter with a `result` label: per value of the other
+    labels, the share of lookups whose result is one of `hits`."""
+
+    def __init__(self, name, help, source: Counter, hits=("hit",)):
+        self.name = name
+        self.help = help
+        self.source = source
+        self.hits = tuple(hits)
+        self._result = source.labelnames.index("result")
+        self.labelnames = tuple(n for n in source.labelnames if n != "result")
+
+    def series(self) -> dict:
+        # derived from the source counter, nothing of its own to store
+        return {}
+
+    def render(self, series=None) -> list[str]:
+        if series is None:
+            series = self.source.series()
+        totals = {}
+        for key, value in series.items():
+            group = key[:self._result] + key[self._result + 1:]
+            hits, lookups = totals.get(group, (0.0, 0.0))
+            totals[group] = (hits + (value if key[self._result] in self.hits else 0.0), lookups + value)
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for group, (hits, lookups) in sorted(totals.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, group)} {hits / lookups if lookups else 0.0}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def hit_ratio(self, name, help, source: Counter, hits=("hit",)) -> HitRatio:
+        metric = HitRatio(name, help, source, hits)
+        self._metrics.append(metric)
+        return metric
+
+    @staticmethod
+    def dump(merged) -> dict:
+        # JSON form of {metric name: {label values: value}}: {metric name: [[label values, value], ...]}
+        return {name: [[list(key), value] for key, value in series.items()] for name, series in merged.items()}
+
+    def state(self) -> dict:
+        return self.dump({metric.name: metric.series() for metric in self._metrics})
+
+    def merge(self, states) -> dict:
+        merged = {metric.name: {} for metric in self._metrics}
+        metrics = {metric.name: metric for metric in self._metrics}
+        for state in states:
+            for name, series in state.items():
+                metric = metrics.get(name)
+                if metric is None:
+                    continue
+                for key, value in series:
+                    key = tuple(key)
+                    current = merged[name].get(key)
+                    merged[name][key] = value if current is None else metric.merge(current, value)
+        return merged
+
+    def render(self, merged=None) -> str:
+        lines = []
+        for metric in self._metrics:
+            # derived metrics render the series of their source
+            source = getattr(metric, "source", metric)
+            lines.extend(metric.render(None if merged is None else merged[source.name]))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsStore:
+    """Shares the metrics of all worker processes through a directory with one file per process.
+
+    Every process writes its series to `<pid>-<id>.json` every `interval` seconds and on shutdown,
+    and `collect` sums the files of all processes, so any worker can answer a scrape. Files of
+    processes that have exited are folded into `archive.json`, so counters keep growing when
+    workers are replaced. The directory is emptied when the server starts (see gunicorn.conf.py).
+    """
+
+    ARCHIVE = "archive.json"
+
+    def __init__(self, path, registry, interval=5):
+        self.path = path
+        self.registry = registry
+        self.interval = interval
+        os.makedirs(path, exist_ok=True)
+        self.file = os.path.join(path, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json")
+        self._task = None
+
+    @staticmethod
+    def _read(file) -> dict:
+        try:
+            with open(file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write(file, state):
+        tmp = file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, file)
+
+    @staticmethod
+    def _alive(file) -> bool:
+        pid = int(os.path.basename(file).split("-", 1)[0])
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def flush(self):
+        self._write(self.file, self.registry.state())
+
+    def collect(self) -> dict:
+        self.flush()
+        archive = os.path.join(self.path, self.ARCHIVE)
+        with open(os.path.join(self.path, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            files = glob.glob(os.path.join(self.path, "*-*.json"))
+            dead = [f for f in files if not self._alive(f)]
+            states = [self._read(archive)]
+            if dead:
+                # fold exited processes into the archive, then drop their files
+                states[0] = self.registry.dump(self.registry.merge(states + [self._read(f) for f in dead]))
+                self._write(archive, states[0])
+                for f in dead:
+                    os.remove(f)
+            states += [self._read(f) for f in files if f not in dead]
+        return self.registry.merge(states)
+
+    def start(self):
+        async def loop():
+            while True:
+                await asyncio.sleep(self.interval)
+                try:
+                    await asyncio.to_thread(self.flush)
+                except Exception:
+                    logging.exception("Failed to write metrics")
+
+        if self._task is None:
+            self._task = asyncio.create_task(loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.flush()
+
+
+REGISTRY = Registry()
+
+HTTP_SECONDS = REGISTRY.histogram(
+    "assistant_http_request_duration_seconds", "Duration of http requests", ["method", "route", "status"]
+)
+STAGE_SECONDS = REGISTRY.histogram(
+    "assistant_stage_duration_seconds", "Duration of search, cosmos and openai calls", ["stage"]
+)
+COSMOS_CHARGE = REGISTRY.histogram(
+    "assistant_cosmos_request_charge", "Request units charged per cosmos request", ["operation", "method"],
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+COSMOS_RU_TOTAL = REGISTRY.counter(
+    "assistant_cosmos_request_units_total", "Request units charged by cosmos", ["operation", "method"]
+)
+OPENAI_TOKENS_TOTAL = REGISTRY.counter(
+    "assistant_openai_tokens_total", "Tokens used by openai calls, estimated when not reported", ["call", "kind"]
+)
+CACHE_REQUESTS_TOTAL = REGISTRY.counter(
+    "assistant_cache_requests_total", "Cache lookups by cache and result (hit or miss)", ["cache", "result"]
+)
+CACHE_HIT_RATIO = REGISTRY.hit_ratio(
+    "assistant_cache_hit_ratio", "Share of cache lookups that were hits", CACHE_REQUESTS_TOTAL
+)
+RESPONSE_CACHE_REQUESTS_TOTAL = REGISTRY.counter(
+    "assistant_response_cache_requests_total", "Response cache lookups by result (exact, similar or miss)", ["result"]
+)
+RESPONSE_CACHE_HIT_RATIO = REGISTRY.hit_ratio(
+    "assistant_response_cache_hit_ratio", "Share of response cache lookups answered from the cache",
+    RESPONSE_CACHE_REQUESTS_TOTAL, hits=("exact", "similar"),
+)
+
+
+@contextlib.contextmanager
+def span(stage, **fields):
+    """Times the enclosed block into the stage histogram and logs it at debug level."""
+    token = stage_var.set(stage)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_var.reset(token)
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        details = "".join(f" {k}={v}" for k, v in fields.items())
+        logging.debug(f"span {stage} {elapsed * 1000:.1f}ms{details}")
+
+
+def timed(stage):
+    """Decorator form of `span` for coroutine methods."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(stage):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_cosmos_response(pipeline_response):
+    # raw_response_hook of the cosmos client, called for every http response including query pages;
+    # the charge is recorded under the operation being timed, e.g. cosmos.load_messages
+    charge = pipeline_response.http_response.headers.get("x-ms-request-charge")
+    if charge is None:
+        return
+    operation = stage_var.get()
+    method = pipeline_response.http_request.method
+    COSMOS_CHARGE.observe(float(charge), operation=operation, method=method)
+    COSMOS_RU_TOTAL.inc(float(charge), operation=operation, method=method)
+
+
+def record_tokens(call, prompt_tokens, completion_tokens=0):
+    OPENAI_TOKENS_TOTAL.inc(prompt_tokens, call=call, kind="prompt")
+    if completion_tokens:
+        OPENAI_TOKENS_TOTAL.inc(completion_tokens, call=call, kind="completion")
+
+
+# set by init_store when metrics are shared across worker processes
+STORE: MetricsStore = None
+
+
+def init_store(path, interval=5) -> MetricsStore:
+    global STORE
+    STORE = MetricsStore(path, REGISTRY, interval)
+    return STORE
+
+
+async def render() -> str:
+    """The metrics of all worker processes with a store, otherwise those of this process."""
+    if STORE is None:
+        return REGISTRY.render()
+    return REGISTRY.render(await asyncio.to_thread(STORE.collect))
@@ -0,0 +1,244 @@
+"""Precomputed default matches for every chassis in the catalog.
+
+The table lives in a directory: `meta.json` names the current version, whose chassis IDs are in
+`ids-<version>.txt` (row i belongs to line i) and whose matches are two arrays of shape
+(rows, count): `neighbors-<version>.npy` holds row numbers of the matching chassis (-1 pads short
+rows) and `scores-<version>.npy` their `_score`; `built-<version>.npy` holds the time each row was
+computed. The arrays are memory-mapped, so every worker process shares the same pages. A build
+writes a new version and then swaps `meta.json`.
+
+Build or update it with:
+
+    python -m src.nearest /path/to/table --workers 8 [--max-age SECONDS] [--full]
+
+Without --full only chassis missing from the table and rows older than --max-age are computed.
+A new chassis only shows up among the matches of older ones once their rows are recomputed, so
+the server ignores rows older than NEAREST_TABLE_MAX_AGE and matches those chassis live.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+META_FILE = "meta.json"
+
+
+class NearestTable:
+    def __init__(self, path, meta, ids, neighbors, scores, built):
+        self.path = path
+        self.meta = meta
+        self.version = meta["version"]
+        self.count = meta["count"]
+        self.mode = meta["mode"]
+        self.ids = ids
+        self.rows = {chassis_id: i for i, chassis_id in enumerate(ids)}
+        self.neighbors = neighbors
+        self.scores = scores
+        self.built = built
+
+    @staticmethod
+    def _files(path, version) -> tuple[str, str, str, str]:
+        return (
+            os.path.join(path, f"ids-{version}.txt"),
+            os.path.join(path, f"neighbors-{version}.npy"),
+            os.path.join(path, f"scores-{version}.npy"),
+            os.path.join(path, f"built-{version}.npy"),
+        )
+
+    @staticmethod
+    def read_meta(path) -> dict:
+        try:
+            with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def load(cls, path) -> "NearestTable":
+        meta = cls.read_meta(path)
+        if meta is None:
+            return None
+        ids_file, neighbors_file, scores_file, built_file = cls._files(path, meta["version"])
+        with open(ids_file, "r", encoding="utf-8") as f:
+            ids = f.read().splitlines()
+        neighbors = np.load(neighbors_file, mmap_mode="r")
+        scores = np.load(scores_file, mmap_mode="r")
+        if os.path.exists(built_file) and scores.dtype == np.float64:
+            built = np.load(built_file, mmap_mode="r")
+        else:
+            # tables written before build times were kept, or with float32 scores that differ from
+            # the live scorer's, count as built at time 0, i.e. stale
+            built = np.zeros(len(ids), dtype=np.float64)
+        return cls(path, meta, ids, neighbors, scores, built)
+
+    def changed(self) -> bool:
+        meta = self.read_meta(self.path)
+        return meta is not None and meta["version"] != self.version
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, chassis_id):
+        return chassis_id in self.rows
+
+    def fresh(self, i, max_age=0) -> bool:
+        return not max_age or self.built[i] >= time.time() - max_age
+
+    def lookup(self, chassis_id, max_age=0) -> list[tuple[str, float]]:
+        """The precomputed (ID, _score) matches of a chassis, best first, or None if it has none;
+        an empty row is a chassis that failed or was not computed yet. With `max_age` (seconds),
+        rows computed longer ago count as missing."""
+        i = self.rows.get(chassis_id)
+        if i is None or not self.fresh(i, max_age):
+            return None
+        found = [
+            (self.ids[j], float(score))
+            for j, score in zip(self.neighbors[i].tolist(), self.scores[i].tolist())
+            if j >= 0
+        ]
+        return found or None
+
+    @classmethod
+    def write(cls, path, ids, matches: dict, *, count, mode, built: dict = None) -> dict:
+        """Write a new version holding `matches` ({ID: [(ID, score), ...]}) for `ids` and make it
+        current; versions older than the previous one are removed. `built` has the build time of
+        rows computed earlier ({ID: time}), other rows get the current time."""
+        os.makedirs(path, exist_ok=True)
+        version = time.strftime("%Y%m%dT%H%M%S") + f"-{os.getpid()}"
+        rows = {chassis_id: i for i, chassis_id in enumerate(ids)}
+        neighbors = np.full((len(ids), count), -1, dtype=np.int32)
+        # float64, so served scores equal the live scorer's and rank the same way
+        scores = np.zeros((len(ids), count), dtype=np.float64)
+        built_at = np.zeros(len(ids), dtype=np.float64)
+        now = time.time()
+        built = built or {}
+        for chassis_id, found in matches.items():
+            i = rows[chassis_id]
+            built_at[i] = built.get(chassis_id, now)
+            found = [(rows[m], score) for m, score in found if m in rows][:count]
+            for k, (j, score) in enumerate(found):
+                neighbors[i, k] = j
+                scores[i, k] = score
+
+        ids_file, neighbors_file, scores_file, built_file = cls._files(path, version)
+        with open(ids_file, "w", encoding="utf-8") as f:
+            f.write("\n".join(ids) + "\n")
+        np.save(neighbors_file, neighbors)
+        np.save(scores_file, scores)
+        np.save(built_file, built_at)
+
+        previous = cls.read_meta(path)
+        meta = {"version": version, "count": count, "mode": mode, "size": len(ids)}
+        tmp = os.path.join(path, META_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(path, META_FILE))
+
+        # keep the previous version for readers that have not reloaded yet
+        keep = {version} | ({previous["version"]} if previous else set())
+        for name in os.listdir(path):
+            stem, _ = os.path.splitext(name)
+            if "-" in stem and stem.split("-", 1)[0] in ("ids", "neighbors", "scores", "built") and stem.split("-", 1)[1] not in keep:
+                os.remove(os.path.join(path, name))
+        return meta
+
+
+# batch job: every worker process computes chunks of chassis with its own search client
+
+_worker_snapshot = None
+
+
+async def _compute(ids, count, concurrency) -> dict:
+    from src import init_search_client
+
+    global _worker_snapshot
+    client = await init_search_client()
+    # the results are written to the table, caching them here would only use memory
+    client.cache = None
+    try:
+        if client.snapshot_source:
+            if _worker_snapshot is None:
+                await client.load_snapshot()
+                _worker_snapshot = client.snapshot
+            client.snapshot = _worker_snapshot
+
+        semaphore = asyncio.Semaphore(concurrency)
+        matches = {}
+
+        async def compute(chassis_id):
+            async with semaphore:
+                try:
+                    results = await client.get_matching_chassis(chassis_id, count)
+                except Exception:
+                    logging.exception(f"Failed to match chassis {chassis_id}")
+                    return
+                matches[chassis_id] = [(r["ID"], r["_score"]) for r in results]
+
+        await asyncio.gather(*(compute(chassis_id) for chassis_id in ids))
+        return matches
+    finally:
+        await client.close()
+
+
+def _compute_chunk(ids, count, concurrency) -> dict:
+    return asyncio.run(_compute(ids, count, concurrency))
+
+
+async def _catalog_ids() -> tuple[list[str], str]:
+    from src import init_search_client
+    from src.snapshot import ChassisSnapshot
+
+    client = await init_search_client()
+    try:
+        snapshot = await ChassisSnapshot.dump_index(client.search_client, [], select=["ID"])
+        return [doc["ID"] for doc in snapshot.documents], client.match_mode
+    finally:
+        await client.close()
+
+
+def build(path, *, count=10, workers=None, chunk_size=200, concurrency=8, full=False, max_age=0) -> dict:
+    ids, mode = asyncio.run(_catalog_ids())
+    catalog = set(ids)
+
+    matches = {}
+    built = {}
+    table = None if full else NearestTable.load(path)
+    # rows of tables with float32 scores are all recomputed
+    if table is not None and table.count == count and table.mode == mode and table.scores.dtype == np.float64:
+        # chassis no longer in the catalog are dropped here and filtered from the kept rows on write;
+        # rows older than max_age are recomputed so they can match chassis indexed since
+        matches = {chassis_id: table.lookup(chassis_id, max_age) for chassis_id in table.ids if chassis_id in catalog}
+        matches = {chassis_id: found for chassis_id, found in matches.items() if found is not None}
+        built = {chassis_id: float(table.built[table.rows[chassis_id]]) for chassis_id in matches}
+    todo = [chassis_id for chassis_id in ids if chassis_id not in matches]
+    logging.info(f"{len(ids)} chassis in the catalog, computing matches for {len(todo)}")
+
+    chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for done, computed in enumerate(pool.map(_compute_chunk, chunks, [count] * len(chunks), [concurrency] * len(chunks)), 1):
+            matches.update(computed)
+            logging.info(f"computed chunk {done} of {len(chunks)}")
+
+    return NearestTable.write(path, ids, matches, count=count, mode=mode, built=built)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute the default matches of every chassis.")
+    parser.add_argument("path", help="table directory, the NEAREST_TABLE_PATH of the server")
+    parser.add_argument("--count", type=int, default=10, help="matches per chassis")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to the cpu count")
+    parser.add_argument("--chunk-size", type=int, default=200, help="chassis per task")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent matches per worker")
+    parser.add_argument("--max-age", type=int, default=int(os.getenv("NEAREST_TABLE_MAX_AGE", "604800")), help="recompute rows older than this many seconds, 0 keeps them")
+    parser.add_argument("--full", action="store_true", help="recompute every chassis")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    from dotenv import load_dotenv
+    load_dotenv()
+    meta = build(args.path, count=args.count, workers=args.workers, chunk_size=args.chunk_size, concurrency=args.concurrency, full=args.full, max_age=args.max_age)
+    print(json.dumps(meta))
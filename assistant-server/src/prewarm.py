@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+
+class Prewarmer:
+    """Fills the search cache for chassis scheduled in the next `horizon_days` days.
+
+    Every `interval` seconds the upcoming schedule is read (up to `batch` chassis by ascending
+    `schedule_date`) and each chassis without a cached default match is fetched and matched, at
+    most `concurrency` at a time. Work only starts while `idle()` returns true, and pauses so that
+    prewarming uses no more than `cpu_budget` of a core of this process.
+
+    Prewarmed entries are kept until the day after the chassis is scheduled instead of the cache's
+    default TTL. Each chassis adds two entries (the chassis and its match), so a batch is limited
+    to `cache_share` of the cache's maxsize to leave room for live traffic.
+    """
+
+    # entries per prewarmed chassis: the chassis document and its default match
+    ENTRIES_PER_CHASSIS = 2
+
+    def __init__(self, search_client, *, idle=None, horizon_days=7, interval=600, batch=500, concurrency=2, cpu_budget=0.25, count_needed=10, cache_share=0.25):
+        self.search_client = search_client
+        self.idle = idle or (lambda: True)
+        self.horizon_days = horizon_days
+        self.interval = interval
+        self.batch = batch
+        self.concurrency = concurrency
+        self.cpu_budget = cpu_budget
+        self.count_needed = count_needed
+        self.cache_share = cache_share
+        self.warmed = 0
+        self.failed = 0
+        self._task = None
+
+    def batch_size(self) -> int:
+        maxsize = getattr(self.search_client.cache, "maxsize", None)
+        if maxsize is None:
+            # e.g. redis, which evicts by memory
+            return self.batch
+        return min(self.batch, int(maxsize * self.cache_share) // self.ENTRIES_PER_CHASSIS)
+
+    @staticmethod
+    def ttl(schedule_date, now=None) -> int:
+        """Seconds until the end of the day after `schedule_date` (an ISO date or date-time)."""
+        now = now or datetime.now(timezone.utc)
+        day = datetime.fromisoformat(str(schedule_date)[:10]).replace(tzinfo=timezone.utc)
+        return max(0, int((day + timedelta(days=2) - now).total_seconds()))
+
+    async def upcoming(self) -> list[tuple[str, str]]:
+        """(ID, schedule_date) of the next chassis to be built, earliest first."""
+        now = datetime.now(timezone.utc)
+        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + timedelta(days=self.horizon_days)
+
+        snapshot = self.search_client.snapshot
+        if snapshot is not None:
+            # ISO dates compare in order as strings
+            lo, hi = start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+            scheduled = [
+                doc for doc in snapshot.documents
+                if doc.get("schedule_date") and lo <= str(doc["schedule_date"])[:10] <= hi
+            ]
+            scheduled.sort(key=lambda doc: str(doc["schedule_date"]))
+            return [(doc["ID"], doc["schedule_date"]) for doc in scheduled[:self.batch_size()]]
+
+        iterator = await self.search_client.search_client.search(
+            search_text="*",
+            filter=f"schedule_date ge {start.strftime('%Y-%m-%dT%H:%M:%SZ')} and schedule_date le {end.strftime('%Y-%m-%dT%H:%M:%SZ')}",
+            order_by=["schedule_date asc"],
+            select=["ID", "schedule_date"],
+            top=self.batch_size(),
+        )
+        return [(doc["ID"], doc["schedule_date"]) async for doc in iterator]
+
+    async def _wait_for_idle(self):
+        while not self.idle():
+            await asyncio.sleep(1)
+
+    async def warm(self, upcoming):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        wall_start = time.monotonic()
+        cpu_start = time.process_time()
+
+        async def warm_one(chassis_id, schedule_date):
+            async with semaphore:
+                await self._wait_for_idle()
+                try:
+                    ttl = max(self.ttl(schedule_date), self.search_client.cache.ttl)
+                    await self.search_client.get_chassis_by_id(chassis_id, cache_ttl=ttl)
+                    await self.search_client.get_matching_chassis(chassis_id, self.count_needed, cache_ttl=ttl)
+                    self.warmed += 1
+                except Exception:
+                    self.failed += 1
+                    logging.exception(f"Failed to prewarm chassis {chassis_id}")
+
+                # cpu time is per process, so this also counts requests served meanwhile
+                cpu = time.process_time() - cpu_start
+                wall = time.monotonic() - wall_start
+                if self.cpu_budget and cpu > self.cpu_budget * wall:
+                    await asyncio.sleep(cpu / self.cpu_budget - wall)
+
+        await asyncio.gather(*(warm_one(chassis_id, schedule_date) for chassis_id, schedule_date in upcoming))
+
+    async def run_once(self):
+        upcoming = await self.upcoming()
+        todo = [entry for entry in upcoming if not await self.search_client.has_cached_match(entry[0], self.count_needed)]
+        logging.info(f"Prewarming {len(todo)} of {len(upcoming)} upcoming chassis")
+        await self.warm(todo)
+
+    def start(self):
+        async def loop():
+            while True:
+                try:
+                    await self._wait_for_idle()
+                    await self.run_once()
+                except Exception:
+                    logging.exception("Prewarm run failed")
+                await asyncio.sleep(self.interval)
+
+        if self._task is None:
+            self._task = asyncio.create_task(loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {"warmed": self.warmed, "failed": self.failed}
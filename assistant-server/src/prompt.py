@@ -0,0 +1,132 @@
+import logging
+from src.cache import TTLCache
+
+try:
+    import tiktoken
+except ImportError:  # in requirements.txt; without it token counts are only estimated
+    tiktoken = None
+
+
+PREAMBLE = [
+    {
+        "role": "system",
+        "content": "You are Chassis design engineer assistant. A chassis engineer (working on the design of the chassis for a truck ordered by customer) is chatting with you. He is given a bunch of chassis that are similar to the chassis he is designing. Help answer his questions. When possible, display the results in tabular format. He may refer to the the base chassis as 'my chassis' or 'current chassis' and to the matching chassis as search results.",
+    },
+    {"role": "user", "content": "Show me the related chassis to my base chassis."},
+]
+
+# approximate per-message overhead of the chat format, in tokens
+MESSAGE_OVERHEAD = 4
+
+
+class PromptBuilder:
+    """Builds the chat prompt for a conversation within a token budget.
+
+    Stored messages never change once written (assistant messages once completed), so the rendered
+    text and token count of each is cached by message id and a turn only tokenizes the new
+    question. When the prompt is over budget the oldest chat turns are dropped first; the preamble,
+    the latest search results and the new question are always kept, and the search results are
+    truncated as a last resort.
+
+    Tokens are counted with tiktoken. If it or its encoding cannot be loaded, counts are estimated
+    as a quarter of the characters, so the budget is only approximate.
+    """
+
+    def __init__(self, *, budget=16000, cache_size=2048, encoding="cl100k_base"):
+        self.budget = budget
+        self.rendered = TTLCache(maxsize=cache_size, ttl=24 * 3600, name="prompt")
+        self._encoding = None
+        if tiktoken is None:
+            logging.warning("tiktoken is not installed, estimating token counts")
+        else:
+            try:
+                self._encoding = tiktoken.get_encoding(encoding)
+            except Exception:
+                logging.exception(f"Could not load tiktoken encoding {encoding}, estimating token counts")
+        self._preamble_tokens = sum(self._message_tokens(m) for m in PREAMBLE)
+
+    def count_tokens(self, text) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        return len(text) // 4 + 1
+
+    def _message_tokens(self, message) -> int:
+        return self.count_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+    @staticmethod
+    def _render(m) -> str:
+        if m["sender"] != "search_results":
+            return m["content"]
+        lines = [f"My chassis (base):\nID: {m['baseChassis']['ID']}\n{m['baseChassis']['description']}\n\nRelated Chassis:\n"]
+        for id, r in enumerate(m["results"]):
+            lines.append(f"Item {id+1} ID: {r['ID']}\n{r['description']}\n\n")
+        return "".join(lines)
+
+    async def _rendered(self, m) -> dict:
+        # {"content", "tokens"} of a stored message, tokens including the message overhead
+        entry = await self.rendered.get(m["id"])
+        if entry is None:
+            content = self._render(m)
+            entry = {"content": content, "tokens": self.count_tokens(content) + MESSAGE_OVERHEAD}
+            await self.rendered.set(m["id"], entry)
+        return entry
+
+    async def render_search_results(self, m) -> str:
+        return (await self._rendered(m))["content"]
+
+    async def _history(self, conv) -> tuple[list[dict], list[int], int]:
+        # returns the chat history since the last search request, the token count of each of its
+        # messages and the index of the latest search results
+        messages = []
+        costs = []
+        context = None
+        for m in conv["messages"]:
+            if m["sender"] == "user":
+                role = "user"
+            elif m["sender"] == "assistant" and m["state"] == "completed":
+                role = "assistant"
+            elif m["sender"] == "search_request":
+                logging.debug("found a new search request, deleting previous chat_history")
+                messages = []
+                costs = []
+                context = None
+                continue
+            elif m["sender"] == "search_results":
+                context = len(messages)
+                role = "assistant"
+            else:
+                continue
+            entry = await self._rendered(m)
+            messages.append({"role": role, "content": entry["content"]})
+            costs.append(entry["tokens"])
+        return messages, costs, context
+
+    async def build(self, conv, question) -> tuple[list[dict], int]:
+        """The prompt messages and their token count."""
+        history, costs, context = await self._history(conv)
+        question = {"role": "user", "content": question}
+
+        total = self._preamble_tokens + self._message_tokens(question) + sum(costs)
+
+        keep = [True] * len(history)
+        for i in range(len(history)):
+            if total <= self.budget:
+                break
+            if i == context:
+                continue
+            keep[i] = False
+            total -= costs[i]
+
+        if context is not None and total > self.budget:
+            # only the search results are left to cut
+            allowed = max(0, self.budget - (total - costs[context]) - MESSAGE_OVERHEAD)
+            content = history[context]["content"]
+            cut = len(content) * allowed // max(1, costs[context])
+            history[context] = {"role": "assistant", "content": content[:cut] + "\n[search results truncated]"}
+            total += self._message_tokens(history[context]) - costs[context]
+
+        dropped = keep.count(False)
+        if dropped:
+            logging.info(f"Prompt over budget of {self.budget} tokens, dropped {dropped} older messages")
+
+        return PREAMBLE + [m for m, k in zip(history, keep) if k] + [question], total
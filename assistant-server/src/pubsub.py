@@ -0,0 +1,130 @@
+import asyncio
+import contextlib
+import json
+import logging
+import uuid
+
+
+class MessageBroker:
+    """In-process fan-out of chat message events to subscribers, keyed by message id.
+
+    Events only reach subscribers in the same worker process as the publisher; subscribers
+    elsewhere have to fall back to reading the message from cosmos. See RedisMessageBroker for
+    delivery across workers.
+    """
+
+    # whether events reach subscribers in other worker processes
+    shared = False
+
+    def __init__(self, queue_size=1024):
+        self.queue_size = queue_size
+        self._subscribers: dict[str, set[asyncio.Queue]] = {}
+
+    def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def publish(self, message_id, event: dict):
+        self._deliver(message_id, event)
+
+    def _deliver(self, message_id, event: dict):
+        for queue in self._subscribers.get(message_id, ()):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                logging.warning(f"Dropping event for slow subscriber of message {message_id}")
+
+    def has_subscribers(self, message_id) -> bool:
+        return bool(self._subscribers.get(message_id))
+
+    @contextlib.contextmanager
+    def subscribe(self, message_id):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(message_id, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            subscribers = self._subscribers.get(message_id)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    del self._subscribers[message_id]
+
+
+class RedisMessageBroker(MessageBroker):
+    """Message events shared by all worker processes through Redis pub/sub.
+
+    Events go to local subscribers directly and are published in order on the channel
+    `<prefix><message id>`. Each process holds one pattern subscription on `<prefix>*` and hands
+    events published by other processes to its local subscribers; events for messages nobody
+    here listens to are skipped without decoding. While Redis is unreachable, subscribers still
+    fall back to reading the message from cosmos. Requires the `redis` package.
+    """
+
+    shared = True
+
+    def __init__(self, url, *, prefix="events:", queue_size=1024, outbox_size=10000):
+        import redis.asyncio as redis
+
+        super().__init__(queue_size)
+        self.prefix = prefix
+        self.origin = uuid.uuid4().hex
+        self._client = redis.Redis.from_url(url, socket_timeout=5)
+        self._outbox = asyncio.Queue(maxsize=outbox_size)
+        self._tasks = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._send()), asyncio.create_task(self._receive())]
+
+    def publish(self, message_id, event: dict):
+        self._deliver(message_id, event)
+        try:
+            self._outbox.put_nowait((message_id, event))
+        except asyncio.QueueFull:
+            logging.warning(f"Event outbox full, not sharing event of message {message_id}")
+
+    async def _send(self):
+        # a single sender keeps the events of a message in publish order
+        while True:
+            message_id, event = await self._outbox.get()
+            try:
+                payload = json.dumps({"origin": self.origin, "event": event})
+                await self._client.publish(self.prefix + message_id, payload)
+            except Exception:
+                logging.exception(f"Failed to share event of message {message_id}")
+            finally:
+                self._outbox.task_done()
+
+    async def _receive(self):
+        while True:
+            try:
+                async with self._client.pubsub() as pubsub:
+                    await pubsub.psubscribe(self.prefix + "*")
+                    async for item in pubsub.listen():
+                        if item["type"] != "pmessage":
+                            continue
+                        message_id = item["channel"].decode("utf-8")[len(self.prefix):]
+                        if not self.has_subscribers(message_id):
+                            continue
+                        data = json.loads(item["data"])
+                        if data["origin"] != self.origin:
+                            self._deliver(message_id, data["event"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("Lost the message event subscription, reconnecting")
+                await asyncio.sleep(1)
+
+    async def close(self, timeout=5):
+        try:
+            await asyncio.wait_for(self._outbox.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"{self._outbox.qsize()} message events not shared at shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self._client.aclose()
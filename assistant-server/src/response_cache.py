@@ -0,0 +1,97 @@
+import hashlib
+import json
+import logging
+import re
+import numpy as np
+from src.cache import CacheBackend
+from src.metrics import span, record_tokens, RESPONSE_CACHE_REQUESTS_TOTAL
+
+
+def normalize(text) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class ResponseCache:
+    """Caches assistant answers for a prompt.
+
+    The exact key is a hash of the prompt messages with whitespace and case normalized. With an
+    `embedding_client`, a miss falls back to comparing the embedding of the question with earlier
+    questions asked over the same context (all messages but the last), and a cosine similarity of
+    at least `similarity` counts as a hit. Up to `max_candidates` questions are kept per context.
+    """
+
+    def __init__(self, backend: CacheBackend, *, embedding_client=None, embedding_model=None, similarity=0.95, max_candidates=32):
+        self.backend = backend
+        self.embedding_client = embedding_client
+        self.embedding_model = embedding_model
+        self.similarity = similarity
+        self.max_candidates = max_candidates
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _hash(messages) -> str:
+        normalized = [[m["role"], normalize(m["content"])] for m in messages]
+        return hashlib.sha256(json.dumps(normalized).encode("utf-8")).hexdigest()
+
+    async def _embed(self, text) -> list[float]:
+        if self.embedding_client is None:
+            return None
+        try:
+            with span("openai.embedding"):
+                resp = await self.embedding_client.embeddings.create(input=[normalize(text)], model=self.embedding_model)
+            if getattr(resp, "usage", None):
+                record_tokens("embedding", resp.usage.prompt_tokens)
+            return resp.data[0].embedding
+        except Exception:
+            logging.exception("Failed to embed question for the response cache")
+            return None
+
+    async def get(self, messages) -> tuple[str, list[float]]:
+        """Returns the cached answer, or None, and the question embedding to pass on to `set`."""
+        answer = await self.backend.get(f"answer:{self._hash(messages)}")
+        if answer is not None:
+            self.exact_hits += 1
+            RESPONSE_CACHE_REQUESTS_TOTAL.inc(result="exact")
+            return answer, None
+
+        vector = await self._embed(messages[-1]["content"])
+        if vector is not None:
+            candidates = await self.backend.get(f"context:{self._hash(messages[:-1])}")
+            if candidates:
+                matrix = np.array([c["embedding"] for c in candidates], dtype=np.float32)
+                query = np.array(vector, dtype=np.float32)
+                scores = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-9)
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity:
+                    self.semantic_hits += 1
+                    RESPONSE_CACHE_REQUESTS_TOTAL.inc(result="similar")
+                    return candidates[best]["answer"], vector
+
+        self.misses += 1
+        RESPONSE_CACHE_REQUESTS_TOTAL.inc(result="miss")
+        return None, vector
+
+    async def set(self, messages, answer, vector=None):
+        await self.backend.set(f"answer:{self._hash(messages)}", answer)
+        if vector is None:
+            return
+        key = f"context:{self._hash(messages[:-1])}"
+        candidates = await self.backend.get(key) or []
+        # keep the newest max_candidates - 1; a negative slice start of -0 would keep them all
+        candidates = candidates[max(0, len(candidates) - self.max_candidates + 1):] + [{"embedding": list(vector), "answer": answer}]
+        await self.backend.set(key, candidates)
+
+    async def stats(self) -> dict:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+            "backend": await self.backend.stats(),
+        }
+
+    async def close(self):
+        await self.backend.close()
@@ -0,0 +1,51 @@
+import json
+import numpy as np
+
+
+def hashable(value):
+    # search documents may hold lists or objects; compare those by their JSON form
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return ("__json__", json.dumps(value, sort_keys=True, default=str))
+
+
+class BatchScorer:
+    """Scores candidate chassis against a base chassis, one column per search key.
+
+    Attribute values are encoded into per-key integer codes, so a whole batch of candidates is
+    compared with the base row in a single vectorized operation. A key's weight is its `weight`
+    entry if present, otherwise `mandatory_weight` or `removeable_weight` depending on its
+    `mandatory` flag. With the default weights of 1 the score is the fraction of matching keys,
+    identical to a pairwise comparison.
+    """
+
+    def __init__(self, base_chassis: dict, search_keys: list[dict], *, mandatory_weight=1.0, removeable_weight=1.0):
+        self.key_names = [key['name'] for key in search_keys]
+        self.weights = np.array(
+            [
+                key.get('weight', mandatory_weight if key.get('mandatory') else removeable_weight)
+                for key in search_keys
+            ],
+            dtype=np.float64,
+        )
+        self.total_weight = self.weights.sum()
+        self._codes = [{} for _ in self.key_names]
+        self.base_row = self.encode([base_chassis])[0]
+
+    def encode(self, chassis_list: list[dict]) -> np.ndarray:
+        matrix = np.empty((len(chassis_list), len(self.key_names)), dtype=np.int32)
+        for j, name in enumerate(self.key_names):
+            codes = self._codes[j]
+            matrix[:, j] = [
+                codes.setdefault(hashable(chassis.get(name)), len(codes))
+                for chassis in chassis_list
+            ]
+        return matrix
+
+    def score(self, chassis_list: list[dict]) -> list[float]:
+        if len(chassis_list) == 0:
+            return []
+        matches = self.encode(chassis_list) == self.base_row
+        return (matches @ self.weights / self.total_weight).tolist()
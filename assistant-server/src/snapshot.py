@@ -0,0 +1,119 @@
+import json
+import numpy as np
+from src.scoring import hashable
+
+
+class ChassisSnapshot:
+    """In-memory copy of the chassis index used to run the relaxation search locally.
+
+    Every search key is stored as a column of integer codes. Per (key, value) postings are bitsets
+    (python ints, bit i set for document i) built on first use from the column, so a relaxation
+    level is an AND of a few bitsets and its count a popcount.
+
+    Criteria match on value equality, which is what the mandatory `eq` filters and the removeable
+    `name: 'value'` clauses of the remote search amount to for the keyword fields of the index. Matches come back in snapshot
+    order rather than by search relevance, so chassis with equal `_score` may be ordered
+    differently than on the remote path.
+    """
+
+    def __init__(self, documents: list[dict], key_names: list[str], fields: list[str] = None):
+        self.documents = [
+            {
+                k: v for k, v in doc.items()
+                if not k.startswith("@search.") and (fields is None or k in fields)
+            }
+            for doc in documents
+        ]
+        self.key_names = key_names
+        self.size = len(self.documents)
+        self.positions = {doc["ID"]: i for i, doc in enumerate(self.documents)}
+        self._all = (1 << self.size) - 1
+
+        self.vocab = {}
+        self.columns = {}
+        for name in key_names:
+            codes = {}
+            self.columns[name] = np.fromiter(
+                (codes.setdefault(hashable(doc.get(name)), len(codes)) for doc in self.documents),
+                dtype=np.int32,
+                count=self.size,
+            )
+            self.vocab[name] = codes
+        self._postings = {}
+
+    @classmethod
+    def load(cls, path, key_names, fields=None) -> "ChassisSnapshot":
+        """Load an export file: a JSON array of documents or one document per line."""
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        if text.lstrip().startswith("["):
+            documents = json.loads(text)
+        else:
+            documents = [json.loads(line) for line in text.splitlines() if line.strip()]
+        return cls(documents, key_names, fields)
+
+    @classmethod
+    async def dump_index(cls, search_client, key_names, *, select=None, page_size=1000) -> "ChassisSnapshot":
+        """Page through the whole index ordered by ID, using the last ID seen as the cursor."""
+        documents = []
+        last_id = None
+        while True:
+            kwargs = {}
+            if last_id is not None:
+                kwargs["filter"] = "ID gt '{}'".format(last_id.replace("'", "''"))
+            iterator = await search_client.search(
+                search_text="*",
+                order_by=["ID asc"],
+                top=page_size,
+                select=select,
+                **kwargs,
+            )
+            page = [doc async for doc in iterator]
+            documents.extend(page)
+            if len(page) < page_size:
+                break
+            last_id = page[-1]["ID"]
+        return cls(documents, key_names)
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for doc in self.documents:
+                f.write(json.dumps(doc) + "\n")
+
+    def get(self, chassis_id) -> dict:
+        i = self.positions.get(chassis_id)
+        if i is None:
+            return None
+        return dict(self.documents[i])
+
+    def _posting(self, name, value) -> int:
+        code = self.vocab[name].get(hashable(value))
+        if code is None:
+            return 0
+        posting = self._postings.get((name, code))
+        if posting is None:
+            packed = np.packbits(self.columns[name] == code, bitorder="little")
+            posting = int.from_bytes(packed.tobytes(), "little")
+            self._postings[(name, code)] = posting
+        return posting
+
+    def match(self, criteria: list[tuple], exclude_id=None) -> int:
+        bits = self._all
+        for name, value in criteria:
+            bits &= self._posting(name, value)
+            if not bits:
+                return 0
+        if exclude_id is not None and exclude_id in self.positions:
+            bits &= ~(1 << self.positions[exclude_id])
+        return bits
+
+    def count(self, criteria: list[tuple], exclude_id=None) -> int:
+        return self.match(criteria, exclude_id).bit_count()
+
+    def search(self, criteria: list[tuple]) -> list[dict]:
+        bits = self.match(criteria)
+        if not bits:
+            return []
+        packed = np.frombuffer(bits.to_bytes((self.size + 7) // 8, "little"), dtype=np.uint8)
+        positions = np.flatnonzero(np.unpackbits(packed, bitorder="little")[:self.size])
+        return [dict(self.documents[i]) for i in positions]
@@ -0,0 +1,25 @@
+import pytest
+
+from src.ai_search import AISearchClient
+from bench.fakes import FakeSearchClient, make_catalog
+
+
+@pytest.fixture(scope="session")
+def catalog():
+    return make_catalog(400, seed=1)
+
+
+@pytest.fixture
+def make_search_client(catalog):
+    """Builds an AISearchClient over the fake search service; call it inside the event loop."""
+    async def make(documents=None, **kwargs):
+        client = AISearchClient("https://test.search.windows.net/", "test", "test", **kwargs)
+        await client.search_client.close()
+        client.search_client = FakeSearchClient(documents if documents is not None else catalog)
+        return client
+    return make
+
+
+def custom_keys(mandatory=3, count=12) -> list[dict]:
+    keys = AISearchClient.search_keys(None)[:count]
+    return [dict(key, selected=True, mandatory=i < mandatory) for i, key in enumerate(keys)]
@@ -0,0 +1,34 @@
+import asyncio
+
+from conftest import custom_keys
+
+
+def test_hybrid_keyword_leg_matches_any_key(catalog, make_search_client):
+    # the keyword leg must rank chassis by how many keys they share; if it required every key it
+    # would match next to nothing and leave only the vector neighbours
+    chassis_ids = [doc["ID"] for doc in catalog[:20]]
+    keys = custom_keys(0)
+    names = [key['name'] for key in keys]
+
+    async def run():
+        client = await make_search_client(match_mode="hybrid")
+        return [await client.get_matching_chassis_custom(chassis_id, keys, 10) for chassis_id in chassis_ids]
+
+    for base, results in zip(catalog, asyncio.run(run())):
+        # the chassis sharing the most keys is always among the candidates
+        best = max(sum(doc[name] == base[name] for name in names) for doc in catalog if doc["ID"] != base["ID"])
+        assert max(r["_score"] for r in results) == best / len(names)
+
+
+def test_hybrid_filters_mandatory_keys(catalog, make_search_client):
+    keys = custom_keys(2)
+    mandatory = [key['name'] for key in keys if key['mandatory']]
+
+    async def run():
+        client = await make_search_client(match_mode="hybrid")
+        return await client.get_matching_chassis_custom(catalog[0]["ID"], keys, 10)
+
+    results = asyncio.run(run())
+    assert results
+    for result in results:
+        assert all(result[name] == catalog[0][name] for name in mandatory)
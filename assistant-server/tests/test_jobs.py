@@ -0,0 +1,42 @@
+import asyncio
+
+from src.jobs import JobScheduler
+
+
+def test_drain_fails_cancelled_and_queued_jobs():
+    failed = []
+
+    async def run():
+        jobs = JobScheduler(concurrency=1, queue_size=10, timeout=60)
+        jobs.start()
+        for job_id in ["running", "queued-1", "queued-2"]:
+            async def on_failure(error, job_id=job_id):
+                await asyncio.sleep(0)
+                failed.append((job_id, type(error)))
+            jobs.submit(job_id, lambda: asyncio.sleep(60), on_failure=on_failure)
+        await asyncio.sleep(0.05)
+        await jobs.drain(timeout=0.05)
+
+    asyncio.run(run())
+    assert sorted(failed) == sorted((job_id, asyncio.CancelledError) for job_id in ["running", "queued-1", "queued-2"])
+
+
+def test_retries_then_fails():
+    attempts, failed = [], []
+
+    async def job():
+        attempts.append(1)
+        raise ValueError("boom")
+
+    async def on_failure(error):
+        failed.append(error)
+
+    async def run():
+        jobs = JobScheduler(concurrency=1, retries=2, backoff=0, retry_on=(ValueError,))
+        jobs.start()
+        jobs.submit("job", job, on_failure=on_failure)
+        await jobs.drain(timeout=5)
+
+    asyncio.run(run())
+    assert len(attempts) == 3
+    assert len(failed) == 1 and isinstance(failed[0], ValueError)
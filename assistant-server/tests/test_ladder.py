@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from conftest import custom_keys
+
+CHASSIS = 30
+
+
+def ranking(results) -> list[tuple[str, float]]:
+    return [(result["ID"], result["_score"]) for result in results]
+
+
+async def match_all(client, chassis_ids, search_keys, **kwargs):
+    rankings = []
+    for chassis_id in chassis_ids:
+        if search_keys is None:
+            results = await client.get_matching_chassis(chassis_id, 10, **kwargs)
+        else:
+            results = await client.get_matching_chassis_custom(chassis_id, search_keys, 10, **kwargs)
+        rankings.append(ranking(results))
+    return rankings
+
+
+@pytest.mark.parametrize("search_keys", [None, custom_keys(0), custom_keys(3)], ids=["default", "custom", "mandatory"])
+@pytest.mark.parametrize("strategy,concurrency", [("ladder", 3), ("ladder", 8), ("probe", 1), ("probe", 4)])
+def test_strategies_match_sequential_ladder(catalog, make_search_client, search_keys, strategy, concurrency):
+    chassis_ids = [doc["ID"] for doc in catalog[:CHASSIS]]
+
+    async def run():
+        client = await make_search_client()
+        expected = await match_all(client, chassis_ids, search_keys, strategy="ladder", concurrency=1)
+        actual = await match_all(client, chassis_ids, search_keys, strategy=strategy, concurrency=concurrency)
+        return expected, actual
+
+    expected, actual = asyncio.run(run())
+    assert actual == expected
+    # mandatory keys can leave fewer than 10 candidates, but every chassis has some
+    assert all(expected)
+
+
+def test_probe_fetches_fewer_levels(catalog, make_search_client):
+    chassis_ids = [doc["ID"] for doc in catalog[:CHASSIS]]
+
+    async def run():
+        ladder = await make_search_client(match_strategy="ladder")
+        probe = await make_search_client(match_strategy="probe")
+        await match_all(ladder, chassis_ids, None)
+        await match_all(probe, chassis_ids, None)
+        return ladder.search_client.ops, probe.search_client.ops
+
+    ladder_ops, probe_ops = asyncio.run(run())
+    assert probe_ops["search"] < ladder_ops["search"]
+
+
+@pytest.mark.parametrize("concurrency", [1, 3])
+def test_probe_respects_concurrency(catalog, make_search_client, concurrency):
+    chassis_ids = [doc["ID"] for doc in catalog[:CHASSIS]]
+    in_flight = {"now": 0, "max": 0}
+
+    async def run():
+        client = await make_search_client(match_strategy="probe", match_concurrency=concurrency)
+        search_level = client._search_level
+
+        async def tracked(level):
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+            try:
+                await asyncio.sleep(0)
+                return await search_level(level)
+            finally:
+                in_flight["now"] -= 1
+
+        client._search_level = tracked
+        await match_all(client, chassis_ids, custom_keys(0))
+
+    asyncio.run(run())
+    assert in_flight["max"] <= concurrency
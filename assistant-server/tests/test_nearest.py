@@ -0,0 +1,34 @@
+import time
+
+from src.nearest import NearestTable
+
+
+def test_rows_older_than_max_age_are_not_served(tmp_path):
+    ids = ["A", "B", "C"]
+    matches = {"A": [("B", 0.5), ("C", 0.25)], "B": [("A", 0.5)]}
+    old = time.time() - 3600
+    NearestTable.write(tmp_path, ids, matches, count=2, mode="ladder", built={"B": old})
+
+    table = NearestTable.load(tmp_path)
+    assert table.lookup("A") == [("B", 0.5), ("C", 0.25)]
+    assert table.lookup("B") == [("A", 0.5)]
+    assert table.lookup("B", max_age=60) is None
+    assert table.lookup("A", max_age=60) == [("B", 0.5), ("C", 0.25)]
+    # never computed
+    assert table.lookup("C") is None
+
+
+def test_previous_version_is_kept(tmp_path):
+    NearestTable.write(tmp_path, ["A", "B"], {"A": [("B", 1.0)]}, count=1, mode="ladder")
+    first = NearestTable.load(tmp_path)
+    time.sleep(1)
+    NearestTable.write(tmp_path, ["A", "B"], {"B": [("A", 1.0)]}, count=1, mode="ladder")
+    assert first.changed()
+    assert first.lookup("A") == [("B", 1.0)]
+    assert NearestTable.load(tmp_path).lookup("B") == [("A", 1.0)]
+
+
+def test_scores_keep_full_precision(tmp_path):
+    score = 27 / 34
+    NearestTable.write(tmp_path, ["A", "B"], {"A": [("B", score)]}, count=1, mode="ladder")
+    assert NearestTable.load(tmp_path).lookup("A") == [("B", score)]
@@ -0,0 +1,49 @@
+import asyncio
+
+from src.prompt import PREAMBLE, PromptBuilder
+
+
+def conversation(turns):
+    messages = [
+        {"id": "s", "sender": "search_request", "content": "search"},
+        {
+            "id": "r", "sender": "search_results",
+            "baseChassis": {"ID": "C1", "description": "base " * 50},
+            "results": [{"ID": f"C{i}", "description": "result " * 50} for i in range(2, 12)],
+        },
+    ]
+    for i in range(turns):
+        messages.append({"id": f"u{i}", "sender": "user", "content": f"question {i} " * 20})
+        messages.append({"id": f"a{i}", "sender": "assistant", "state": "completed", "content": f"answer {i} " * 40})
+    return {"messages": messages}
+
+
+def test_build_counts_each_stored_message_once():
+    builder = PromptBuilder(budget=100000)
+    counted = []
+    count_tokens = builder.count_tokens
+    builder.count_tokens = lambda text: counted.append(text) or count_tokens(text)
+    conv = conversation(3)
+
+    async def run():
+        first = await builder.build(conv, "first")
+        counted.clear()
+        second = await builder.build(conv, "second")
+        return first, second
+
+    (_, first_tokens), (messages, tokens) = asyncio.run(run())
+    # only the new question is tokenized again
+    assert counted == ["second"]
+    assert tokens == sum(builder._message_tokens(m) for m in messages)
+    assert tokens - builder.count_tokens("second") == first_tokens - builder.count_tokens("first")
+
+
+def test_build_drops_oldest_turns_over_budget():
+    builder = PromptBuilder(budget=2000)
+    messages, tokens = asyncio.run(builder.build(conversation(10), "latest"))
+    assert tokens <= builder.budget
+    assert tokens == sum(builder._message_tokens(m) for m in messages)
+    assert messages[:len(PREAMBLE)] == PREAMBLE
+    assert messages[len(PREAMBLE)]["content"].startswith("My chassis (base)")
+    assert messages[-1] == {"role": "user", "content": "latest"}
+    assert messages[-2]["content"].startswith("answer 9")
@@ -0,0 +1,36 @@
+import random
+
+from src.ai_search import AISearchClient
+from src.scoring import BatchScorer
+
+from conftest import custom_keys
+
+
+def pairwise_score(chassis1, chassis2, search_keys) -> float:
+    # the original per-pair score: the fraction of keys with equal values
+    names = [key['name'] for key in search_keys]
+    return sum(chassis1.get(name) == chassis2.get(name) for name in names) / len(names)
+
+
+def test_batch_scores_are_identical_to_pairwise(catalog):
+    rnd = random.Random(7)
+    for search_keys in (AISearchClient.search_keys(None), custom_keys(0), custom_keys(3)):
+        for base in rnd.sample(catalog, 20):
+            candidates = rnd.sample(catalog, 100)
+            scores = BatchScorer(base, search_keys).score(candidates)
+            # exact equality on purpose: rankings and ties must not change
+            assert scores == [pairwise_score(c, base, search_keys) for c in candidates]
+
+
+def test_unhashable_and_missing_values():
+    keys = [{"name": "a"}, {"name": "b"}, {"name": "c"}]
+    base = {"a": [1, 2], "b": {"x": 1}}
+    candidates = [{"a": [1, 2], "b": {"x": 1}}, {"a": [2, 1], "b": {"x": 1}, "c": None}, {"c": "z"}]
+    assert BatchScorer(base, keys).score(candidates) == [pairwise_score(c, base, keys) for c in candidates]
+
+
+def test_weights():
+    keys = [{"name": "a", "mandatory": True}, {"name": "b", "mandatory": False}, {"name": "c", "weight": 2}]
+    base = {"a": 1, "b": 1, "c": 1}
+    scorer = BatchScorer(base, keys, mandatory_weight=3, removeable_weight=1)
+    assert scorer.score([{"a": 1, "b": 0, "c": 0}, {"a": 0, "b": 1, "c": 1}, base]) == [0.5, 0.5, 1.0]
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from src.snapshot import ChassisSnapshot
+
+from conftest import custom_keys
+
+CHASSIS = 30
+
+
+async def with_snapshot(client, documents):
+    key_names = [key['name'] for key in client.search_keys(extended=True)]
+    client.snapshot = ChassisSnapshot(documents, key_names, client.select_fields)
+    return client
+
+
+@pytest.mark.parametrize("search_keys", [None, custom_keys(0), custom_keys(3)], ids=["default", "custom", "mandatory"])
+@pytest.mark.parametrize("strategy", ["ladder", "probe"])
+def test_snapshot_matches_remote_scores(catalog, make_search_client, search_keys, strategy):
+    chassis_ids = [doc["ID"] for doc in catalog[:CHASSIS]]
+
+    async def match(client, chassis_id):
+        if search_keys is None:
+            return await client.get_matching_chassis(chassis_id, 10, strategy=strategy)
+        return await client.get_matching_chassis_custom(chassis_id, search_keys, 10, strategy=strategy)
+
+    async def run():
+        remote = await make_search_client()
+        local = await with_snapshot(await make_search_client(), catalog)
+        return [(await match(remote, c), await match(local, c)) for c in chassis_ids]
+
+    for remote, local in asyncio.run(run()):
+        # same scores in the same order; chassis with equal scores may be ordered differently,
+        # so only the ones above the cutoff score must be the same chassis
+        assert [r["_score"] for r in local] == [r["_score"] for r in remote]
+        cutoff = remote[-1]["_score"] if remote else 0
+        assert {r["ID"] for r in local if r["_score"] > cutoff} == {r["ID"] for r in remote if r["_score"] > cutoff}
+
+
+def test_snapshot_counts_match_remote(catalog, make_search_client):
+    async def run():
+        remote = await make_search_client()
+        local = await with_snapshot(await make_search_client(), catalog)
+        for doc in catalog[:CHASSIS]:
+            keys = custom_keys(3)
+            ladder = remote._build_relaxation_ladder(doc, [k for k in keys if k['mandatory']], [k for k in keys if not k['mandatory']])
+            for level in ladder:
+                assert await local._count_level(level, doc["ID"]) == await remote._count_level(level, doc["ID"])
+                count, results = await local._search_level(level)
+                remote_count, remote_results = await remote._search_level(level)
+                assert count == remote_count
+                assert sorted(r["ID"] for r in results) == sorted(r["ID"] for r in remote_results)
+        # the snapshot never calls the service
+        assert local.search_client.ops == {}
+
+    asyncio.run(run())
+
+
+def test_snapshot_falls_back_to_service_for_new_chassis(catalog, make_search_client):
+    # chassis indexed after the snapshot was loaded
+    loaded, new = catalog[:-2], [doc["ID"] for doc in catalog[-2:]]
+
+    async def run():
+        client = await with_snapshot(await make_search_client(), loaded)
+        chassis = await client.get_chassis_by_id(new[0])
+        many = await client.get_chassis_by_ids([loaded[0]["ID"], new[0], "unknown", new[1]])
+        return chassis, many
+
+    chassis, many = asyncio.run(run())
+    assert chassis["ID"] == new[0]
+    assert [doc["ID"] for doc in many] == [loaded[0]["ID"], new[0], new[1]]